@@ -0,0 +1,338 @@
+"""Benchmarks every Metropolis sampler implementation in this directory.
+
+    python benchmark.py run --output results.json
+    python benchmark.py compare baseline.json results.json
+
+run decrypts slices of one book with a model trained on another for
+every combination of ciphertext length, corpus size, iteration count and
+seed, and writes the measurements as JSON. compare matches two such
+files case by case and exits with status 1 when throughput dropped or
+peak memory grew by more than the tolerance.
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_MODULE = os.path.join(
+    HERE, 'mcmc_decryptor_project', 'mcmc_decryptor', 'decryption.py')
+CASE_FIELDS = ('engine', 'length', 'corpus_size', 'iterations')
+
+
+def _load_module(name):
+    if name == 'package':
+        spec = importlib.util.spec_from_file_location(
+            'mcmc_decryptor_package', PACKAGE_MODULE)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return importlib.import_module(name)
+
+
+class Engine:
+    """Adapts one sampler implementation to a common interface.
+
+    build(reference_text) compiles whatever model the sampler uses and
+    sample(module, model, ciphertext, reference_text, iterations) returns
+    a decryption mapping (cipher letter to plain letter) and the log
+    likelihood trace. score(module, model, ciphertext, decryption) gives
+    the log likelihood of a decryption mapping on the same scale as the
+    trace. Samplers that build their model internally report
+    builds_model=True, and the separately timed build is subtracted from
+    their sampling time."""
+
+    def __init__(self, name, module, build, sample, score,
+                 builds_model=False):
+        self.name = name
+        self.module = module
+        self.build = build
+        self.sample = sample
+        self.score = score
+        self.builds_model = builds_model
+
+
+def _score(module, model, ciphertext, decryption):
+    return module.compute_log_likelihood(decryption, ciphertext, model)
+
+
+def _copy_engine(name, module):
+    """The standalone copies that rescore the full text per proposal."""
+    return Engine(
+        name, module,
+        build=lambda module, reference: module.build_frequency_matrix(
+            reference),
+        sample=lambda module, model, ciphertext, reference, iterations: (
+            module.metropolis_sampler_with_logs(
+                ciphertext, reference, iterations=iterations, p=0.5)),
+        score=_score,
+        builds_model=True)
+
+
+def _delta_engine(name, module):
+    """mcmc_decryptor and its packaged copy, given a prebuilt model."""
+    return Engine(
+        name, module,
+        build=lambda module, reference: module.BigramModel.from_text(
+            reference),
+        sample=lambda module, model, ciphertext, reference, iterations: (
+            module.metropolis_sampler_with_logs(
+                ciphertext, model, iterations=iterations, p=0.5)),
+        score=_score)
+
+
+def _sample_bigram(module, model, ciphertext, reference, iterations):
+    key, log_likelihoods = module.metropolis_sampler_with_bigram(
+        ciphertext, model, iterations=iterations)
+    return {cipher: plain for plain, cipher in key.items()}, log_likelihoods
+
+
+def _score_bigram(module, model, ciphertext, decryption):
+    decrypted = ''.join(decryption.get(char, char) for char in ciphertext)
+    return module.calculate_bigram_likelihood(decrypted, model)
+
+
+ENGINES = {
+    'mcmc_decryptor': lambda: _delta_engine(
+        'mcmc_decryptor', 'mcmc_decryptor'),
+    'package': lambda: _delta_engine('package', 'package'),
+    'optimised': lambda: _copy_engine('optimised', 'optimised'),
+    'c_Profile': lambda: _copy_engine('c_Profile', 'c_Profile'),
+    'line_profiling': lambda: _copy_engine(
+        'line_profiling', 'line_profiling'),
+    'bigram': lambda: Engine(
+        'bigram', 'mcmc_text_decryption',
+        build=lambda module, reference: module._count_bigram_probs(
+            [reference]),
+        sample=_sample_bigram,
+        score=_score_bigram),
+}
+
+
+def load_engines(names):
+    """Imports the requested engines; returns them with a dict of the
+    ones that could not be imported and why."""
+    engines, skipped = [], {}
+    for name in names:
+        engine = ENGINES[name]()
+        try:
+            engine.module = _load_module(engine.module)
+        except ImportError as error:
+            skipped[name] = str(error)
+        else:
+            engines.append(engine)
+    return engines, skipped
+
+
+def _accuracy(decryption, ciphertext, plaintext):
+    decrypted = ''.join(decryption.get(char, char) for char in ciphertext)
+    return sum(a == b for a, b in zip(decrypted, plaintext)) / len(plaintext)
+
+
+def _seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def run_case(engine, plaintext, reference, iterations, seed, memory=True):
+    """Measures one engine on one plaintext and reference text."""
+    key = dict(zip('abcdefghijklmnopqrstuvwxyz',
+                   random.Random(seed).sample(
+                       'abcdefghijklmnopqrstuvwxyz', 26)))
+    ciphertext = plaintext.translate(str.maketrans(key))
+    module = engine.module
+
+    start = time.perf_counter()
+    model = engine.build(module, reference)
+    build_time = time.perf_counter() - start
+
+    _seed(seed)
+    start = time.perf_counter()
+    decryption, log_likelihoods = engine.sample(
+        module, model, ciphertext, reference, iterations)
+    elapsed = time.perf_counter() - start
+    sampling_time = max(elapsed - build_time if engine.builds_model
+                        else elapsed, 1e-9)
+    done = len(log_likelihoods) - 1
+
+    accuracy = _accuracy(decryption, ciphertext, plaintext)
+    # The chain has done as well as the correct key from the first
+    # iteration whose score reaches the correct key's score; the
+    # iteration is converted to seconds at the run's average rate.
+    correct_log_likelihood = engine.score(
+        module, model, ciphertext,
+        {cipher: plain for plain, cipher in key.items()})
+    reached = np.flatnonzero(
+        np.asarray(log_likelihoods)
+        >= correct_log_likelihood - 1e-9 * abs(correct_log_likelihood))
+    time_to_correct = (sampling_time * int(reached[0]) / max(done, 1)
+                       if len(reached) else None)
+
+    peak_memory = None
+    if memory:
+        _seed(seed)
+        tracemalloc.start()
+        try:
+            engine.sample(module, engine.build(module, reference),
+                          ciphertext, reference, iterations)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'engine': engine.name,
+        'length': len(plaintext),
+        'corpus_size': len(reference),
+        'iterations': iterations,
+        'seed': seed,
+        'model_build_time': build_time,
+        'sampling_time': sampling_time,
+        'iterations_per_sec': done / sampling_time,
+        'accuracy': accuracy,
+        'time_to_correct_key': time_to_correct,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def run(args):
+    sys.path.insert(0, HERE)
+    from mcmc_decryptor import load_corpus
+
+    engines, skipped = load_engines(args.engines)
+    for name, reason in skipped.items():
+        print(f"skipping {name}: {reason}", file=sys.stderr)
+
+    plaintext_source = load_corpus(os.path.join(HERE, args.plaintext))
+    reference_source = load_corpus(os.path.join(HERE, args.reference))
+    results = []
+    for engine in engines:
+        for length in args.lengths:
+            plaintext = plaintext_source[
+                args.offset:args.offset + length]
+            for corpus_size in args.corpus_sizes:
+                reference = (reference_source[:corpus_size] if corpus_size
+                             else reference_source)
+                for iterations in args.iterations:
+                    for seed in args.seeds:
+                        result = run_case(engine, plaintext, reference,
+                                          iterations, seed, args.memory)
+                        results.append(result)
+                        print(f"{engine.name:>15} length={length} "
+                              f"corpus={len(reference)} "
+                              f"iterations={iterations} seed={seed}: "
+                              f"{result['iterations_per_sec']:.0f} it/s, "
+                              f"accuracy {result['accuracy']:.3f}",
+                              file=sys.stderr)
+
+    report = {
+        'metadata': {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'arguments': {name: value for name, value in vars(args).items()
+                          if name != 'handler'},
+        },
+        'skipped': skipped,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}", file=sys.stderr)
+    return 0
+
+
+def _medians(report, field):
+    groups = {}
+    for result in report['results']:
+        if result.get(field) is not None:
+            groups.setdefault(
+                tuple(result[name] for name in CASE_FIELDS), []).append(
+                    result[field])
+    return {case: statistics.median(values)
+            for case, values in groups.items()}
+
+
+def find_regressions(baseline, current, tolerance=0.1):
+    """Compares the median over seeds of every case present in both
+    reports. Returns a list of messages for cases whose iterations per
+    second fell, or whose peak memory rose, by more than tolerance."""
+    regressions = []
+    checks = (('iterations_per_sec', -1), ('peak_memory_bytes', 1))
+    for field, direction in checks:
+        before = _medians(baseline, field)
+        after = _medians(current, field)
+        for case in sorted(before.keys() & after.keys(), key=str):
+            change = (after[case] - before[case]) / before[case]
+            if change * direction > tolerance:
+                description = ', '.join(
+                    f"{name}={value}" for name, value in zip(
+                        CASE_FIELDS, case))
+                regressions.append(
+                    f"{description}: {field} {before[case]:.4g} -> "
+                    f"{after[case]:.4g} ({change:+.1%})")
+    return regressions
+
+
+def compare(args):
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    regressions = find_regressions(baseline, current, args.tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser(
+        'run', help='run the benchmark matrix and write JSON results')
+    run_parser.add_argument('--engines', nargs='+', choices=list(ENGINES),
+                            default=list(ENGINES))
+    run_parser.add_argument('--lengths', nargs='+', type=int,
+                            default=[250, 1000])
+    run_parser.add_argument(
+        '--corpus-sizes', nargs='+', type=int, default=[200000, 0],
+        help='reference characters to train on; 0 uses the whole book')
+    run_parser.add_argument('--iterations', nargs='+', type=int,
+                            default=[2000])
+    run_parser.add_argument('--seeds', nargs='+', type=int, default=[0, 1])
+    run_parser.add_argument('--plaintext', default='pg74884.txt')
+    run_parser.add_argument('--reference', default='pg74880.txt')
+    run_parser.add_argument('--offset', type=int, default=10000,
+                            help='plaintext character to start from')
+    run_parser.add_argument(
+        '--no-memory', dest='memory', action='store_false',
+        help='skip the extra traced run that measures peak memory')
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser(
+        'compare', help='flag regressions against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
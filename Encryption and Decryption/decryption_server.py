@@ -0,0 +1,562 @@
+"""Local asyncio server that queues decryption jobs and runs them on a
+process pool, streaming the best key found so far.
+
+    python decryption_server.py --reference pg74880.txt --port 8765
+    curl -X POST -d '{"ciphertext": "...", "deadline": 30}' \
+        localhost:8765/jobs
+    curl localhost:8765/jobs/1/events
+
+See JobServer for the endpoints and job options.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+from collections import deque
+
+from mcmc_decryptor import (
+    BigramModel,
+    NgramModel,
+    _as_model,
+    _attach_arrays,
+    _run_message_chain,
+    _share_arrays,
+    apply_decryption,
+    load_corpus,
+)
+
+logger = logging.getLogger(__name__)
+
+JOB_SEGMENT = 1000
+JOB_PREVIEW = 200
+JOB_OPTIONS = ('iterations', 'p', 'plateau', 'entropy_ratio',
+               'max_rejections', 'seed', 'deadline')
+HTTP_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request',
+                404: 'Not Found', 405: 'Method Not Allowed',
+                500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+_job_worker_state = {}
+
+
+def _init_job_worker(name, layout, symbols, events, cancelled):
+    block, (log_probs,) = _attach_arrays(name, layout)
+    model_class = BigramModel if log_probs.ndim == 2 else NgramModel
+    _job_worker_state.update(
+        block=block, model=model_class(log_probs, symbols), events=events,
+        cancelled=cancelled)
+
+
+def _job_worker(task):
+    job_id, slot, ciphertext, seed, options, deadline = task
+    events = _job_worker_state['events']
+    cancelled = _job_worker_state['cancelled']
+    try:
+        return _run_message_chain(
+            _job_worker_state['model'], ciphertext, seed,
+            segment=JOB_SEGMENT,
+            report=lambda event: events.put((job_id, event)),
+            cancelled=lambda: cancelled[slot] == job_id, deadline=deadline,
+            **options)
+    finally:
+        # The result returns through the pool's own pipe, so the server
+        # waits for this marker to know every progress event has arrived
+        events.put((job_id, None))
+
+
+class DecryptionJob:
+    """One ciphertext submitted to a JobServer, with its state and the
+    events published for it so far.
+
+    state is 'queued', 'running', or once the job has finished 'done',
+    'cancelled', 'expired' (its deadline passed while it was queued) or
+    'failed'."""
+
+    FINISHED = ('done', 'cancelled', 'expired', 'failed')
+
+    def __init__(self, job_id, ciphertext, seed, options, deadline=None):
+        self.id = job_id
+        self.ciphertext = ciphertext
+        self.seed = seed
+        self.options = options
+        self.deadline = deadline
+        self.state = 'queued'
+        self.slot = None
+        self.submitted = time.time()
+        self.started = self.finished = None
+        self.result = None
+        self.error = None
+        self.events = []
+        self._changed = asyncio.Event()
+        self._reported = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.state in self.FINISHED
+
+    def publish(self, event):
+        """Appends an event, stamped with the job id and time, and wakes
+        every stream waiting for it."""
+        event = dict(event, job=self.id, time=time.time())
+        self.events.append(event)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def stream(self):
+        """Yields every event of the job, past and future, until the
+        final 'finished' event."""
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.events):
+                index += 1
+                yield self.events[index - 1]
+            if self.done:
+                return
+            await changed.wait()
+
+    def to_dict(self):
+        """JSON-serialisable summary of the job."""
+        summary = {'id': self.id, 'state': self.state,
+                   'submitted': self.submitted, 'started': self.started,
+                   'finished': self.finished, 'deadline': self.deadline,
+                   'length': len(self.ciphertext)}
+        if self.result is not None:
+            summary.update(self.result)
+        if self.error is not None:
+            summary['error'] = self.error
+        return summary
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class JobServer:
+    """Local asyncio server that queues decryption jobs and runs them on
+    a process pool, with the compiled model placed in shared memory and
+    mapped by every worker as it starts.
+
+    reference, order, iterations and p are as for Decryptor; a job may
+    override iterations, p, plateau, entropy_ratio, max_rejections and
+    seed, and set a deadline in seconds after which it stops with the
+    best key found so far. At most max_queue jobs wait for a worker (no
+    limit by default) and further submissions are refused. Only the
+    keep_finished most recently finished jobs are kept; older ones are
+    forgotten, so a long-running server does not grow without bound.
+
+    The HTTP interface, on a TCP port or a Unix socket, exchanges JSON:
+
+        POST   /jobs              submit {"ciphertext": ..., options}
+        GET    /jobs              list the jobs
+        GET    /jobs/<id>         one job, with its result once done
+        GET    /jobs/<id>/events  stream its events as JSON lines
+        DELETE /jobs/<id>         cancel it
+
+    Workers report the best key found so far after each segment of
+    JOB_SEGMENT iterations that improved it, as 'progress' events with a
+    preview of the decrypted text, between a 'started' and a final
+    'finished' event."""
+
+    def __init__(self, reference, order=2, iterations=10000, p=0.5,
+                 processes=None, max_queue=0, keep_finished=1000,
+                 seed=None):
+        self.model = _as_model(reference, order)
+        self.defaults = {'iterations': iterations, 'p': p, 'plateau': None,
+                         'entropy_ratio': None, 'max_rejections': None}
+        self.processes = processes or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.keep_finished = keep_finished
+        self.jobs = {}
+        self._finished = deque()
+        self.address = None
+        self._seeds = random.Random(seed)
+        self._last_id = 0
+        self._server = None
+        self._tasks = []
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Starts the workers and listens on host and port (an ephemeral
+        port by default) or, when path is given, on a Unix socket there.
+        The bound address is kept in self.address."""
+        self._queue = asyncio.Queue(self.max_queue)
+        self._events = multiprocessing.Queue()
+        self._cancelled = multiprocessing.Array('q', self.processes,
+                                                lock=False)
+        self._block, layout = _share_arrays([self.model.log_probs])
+        # Workers are started before any socket is opened, so that none
+        # of them holds a copy of a client connection.
+        self._pool = multiprocessing.Pool(
+            self.processes, initializer=_init_job_worker,
+            initargs=(self._block.name, layout, self.model.symbols,
+                      self._events, self._cancelled))
+        self._tasks = [asyncio.ensure_future(self._dispatch(slot))
+                       for slot in range(self.processes)]
+        self._reader = asyncio.ensure_future(self._read_events())
+        if path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._handle, path)
+            self.address = path
+        else:
+            self._server = await asyncio.start_server(
+                self._handle, host, port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+        return self
+
+    async def close(self):
+        """Stops listening, cancels the queued and running jobs and shuts
+        the workers down."""
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        server.close()
+        for job in list(self.jobs.values()):
+            if not job.done:
+                self.cancel(job.id)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._pool.close()
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._pool.join)
+        for job in list(self.jobs.values()):
+            if not job.done:
+                self._finish(job, 'cancelled')
+        self._events.put(None)
+        await self._reader
+        await server.wait_closed()
+        self._block.close()
+        self._block.unlink()
+
+    async def serve_forever(self):
+        """Serves requests until the task is cancelled."""
+        await self._server.serve_forever()
+
+    async def __aenter__(self):
+        if self._server is None:
+            await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def submit(self, ciphertext, **options):
+        """Queues a ciphertext and returns its DecryptionJob; raises
+        ValueError for unknown options and asyncio.QueueFull when
+        max_queue jobs are already waiting."""
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown job options: {sorted(unknown)}")
+        seed = options.pop('seed', None)
+        if seed is None:
+            seed = self._seeds.getrandbits(64)
+        deadline = options.pop('deadline', None)
+        if deadline is not None:
+            deadline = time.time() + deadline
+        job = DecryptionJob(self._last_id + 1, ciphertext, seed,
+                            dict(self.defaults, **options), deadline)
+        self._queue.put_nowait(job)
+        self._last_id = job.id
+        self.jobs[job.id] = job
+        job.publish({'event': 'queued', 'position': self._queue.qsize()})
+        return job
+
+    def cancel(self, job_id):
+        """Cancels a job: a queued job never runs and a running one stops
+        after its current segment, keeping the best key found so far.
+        Returns the job."""
+        job = self.jobs[job_id]
+        if job.state == 'queued':
+            self._finish(job, 'cancelled')
+        elif job.state == 'running':
+            self._cancelled[job.slot] = job.id
+        return job
+
+    def _finish(self, job, state, result=None, error=None):
+        job.state = state
+        job.finished = time.time()
+        job.result = result
+        job.error = error
+        job.publish(dict(job.to_dict(), event='finished'))
+        self._finished.append(job.id)
+        while len(self._finished) > self.keep_finished:
+            del self.jobs[self._finished.popleft()]
+
+    def _preview(self, job, key):
+        return apply_decryption(key, job.ciphertext[:JOB_PREVIEW])
+
+    def _run_in_pool(self, task):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(method, value):
+            if not future.done():
+                getattr(future, method)(value)
+        self._pool.apply_async(
+            _job_worker, (task,),
+            callback=lambda result: loop.call_soon_threadsafe(
+                resolve, 'set_result', result),
+            error_callback=lambda error: loop.call_soon_threadsafe(
+                resolve, 'set_exception', error))
+        return future
+
+    async def _dispatch(self, slot):
+        while True:
+            job = await self._queue.get()
+            if job.state != 'queued':
+                continue
+            if job.deadline is not None and time.time() >= job.deadline:
+                self._finish(job, 'expired')
+                continue
+            job.state = 'running'
+            job.slot = slot
+            job.started = time.time()
+            job.publish({'event': 'started'})
+            try:
+                key, log_likelihood, info = await self._run_in_pool(
+                    (job.id, slot, job.ciphertext, job.seed, job.options,
+                     job.deadline))
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self._finish(job, 'failed', error=repr(error))
+                continue
+            await job._reported.wait()
+            state = 'cancelled' if info['stop_reason'] == 'cancelled' \
+                else 'done'
+            self._finish(job, state, dict(
+                info, key=key, log_likelihood=log_likelihood,
+                plaintext=apply_decryption(key, job.ciphertext)))
+
+    async def _read_events(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(None, self._events.get)
+            if item is None:
+                return
+            job_id, event = item
+            job = self.jobs.get(job_id)
+            if job is None or job.state != 'running':
+                continue
+            if event is None:
+                job._reported.set()
+            else:
+                job.publish(dict(event,
+                                 preview=self._preview(job, event['key'])))
+
+    async def _handle(self, reader, writer):
+        responded = False
+        try:
+            method, path, body = await _read_http_request(reader)
+            if path.startswith('/jobs/') and path.endswith('/events'):
+                job = self._lookup(path[len('/jobs/'):-len('/events')])
+                if method != 'GET':
+                    raise _HTTPError(405, f"{method} not allowed")
+                writer.write(_http_head(200, 'application/x-ndjson'))
+                responded = True
+                async for event in job.stream():
+                    writer.write(json.dumps(event).encode('utf-8') + b'\n')
+                    await writer.drain()
+            else:
+                status, payload = self._route(method, path, body)
+                _write_json(writer, status, payload)
+        except _HTTPError as error:
+            _write_json(writer, error.status, {'error': str(error)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception("Failed to handle a request")
+            if not responded:
+                _write_json(writer, 500, {'error': "Internal server error"})
+        finally:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    def _lookup(self, job_id):
+        try:
+            return self.jobs[int(job_id)]
+        except (ValueError, KeyError):
+            raise _HTTPError(404, f"No job {job_id}") from None
+
+    def _route(self, method, path, body):
+        if path == '/jobs':
+            if method == 'GET':
+                return 200, [job.to_dict() for job in self.jobs.values()]
+            if method != 'POST':
+                raise _HTTPError(405, f"{method} not allowed")
+            try:
+                request = json.loads(body or b'{}')
+                ciphertext = request.pop('ciphertext')
+                if not isinstance(ciphertext, str):
+                    raise ValueError("ciphertext must be a string")
+                job = self.submit(ciphertext, **request)
+            except (ValueError, KeyError, AttributeError, TypeError) as error:
+                raise _HTTPError(400, f"Invalid job: {error}") from None
+            except asyncio.QueueFull:
+                raise _HTTPError(503, "The job queue is full") from None
+            return 202, job.to_dict()
+        if path.startswith('/jobs/'):
+            job = self._lookup(path[len('/jobs/'):])
+            if method == 'GET':
+                return 200, job.to_dict()
+            if method == 'DELETE':
+                return 200, self.cancel(job.id).to_dict()
+            raise _HTTPError(405, f"{method} not allowed")
+        raise _HTTPError(404, f"No resource {path}")
+
+
+async def _read_http_request(reader):
+    """Reads a request line, headers and Content-Length body; returns the
+    method, the path without its query string and the body."""
+    try:
+        method, target, _ = (await reader.readline()).decode(
+            'latin-1').split(' ', 2)
+    except ValueError:
+        raise _HTTPError(400, "Malformed request line") from None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise _HTTPError(400, "Malformed Content-Length")
+    body = await reader.readexactly(length)
+    return method.upper(), target.split('?', 1)[0].rstrip('/'), body
+
+
+def _http_head(status, content_type, length=None):
+    head = [f"HTTP/1.1 {status} {HTTP_REASONS[status]}",
+            f"Content-Type: {content_type}", "Connection: close"]
+    if length is not None:
+        head.append(f"Content-Length: {length}")
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+
+
+def _write_json(writer, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(_http_head(status, 'application/json', len(body)) + body)
+
+
+class JobClient:
+    """Minimal asyncio client of a JobServer at a TCP host and port or a
+    Unix socket path, one connection per request."""
+
+    def __init__(self, host='127.0.0.1', port=None, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+
+    async def _connect(self, method, target, payload=None):
+        if self.path is not None:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port)
+        body = b'' if payload is None else json.dumps(payload).encode(
+            'utf-8')
+        writer.write(
+            f"{method} {target} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            .encode('latin-1') + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return status, reader, writer
+
+    async def request(self, method, target, payload=None):
+        """Sends one request; returns the decoded JSON response and raises
+        RuntimeError for an error status."""
+        status, reader, writer = await self._connect(method, target,
+                                                     payload)
+        response = json.loads(await reader.read())
+        writer.close()
+        if status >= 400:
+            raise RuntimeError(f"{status}: {response['error']}")
+        return response
+
+    async def submit(self, ciphertext, **options):
+        """Submits a job and returns its summary, including its id."""
+        return await self.request(
+            'POST', '/jobs', dict(options, ciphertext=ciphertext))
+
+    async def job(self, job_id):
+        return await self.request('GET', f'/jobs/{job_id}')
+
+    async def cancel(self, job_id):
+        return await self.request('DELETE', f'/jobs/{job_id}')
+
+    async def events(self, job_id):
+        """Yields the job's events as they are published, ending with the
+        'finished' event."""
+        status, reader, writer = await self._connect(
+            'GET', f'/jobs/{job_id}/events')
+        try:
+            if status >= 400:
+                raise RuntimeError(
+                    f"{status}: {json.loads(await reader.read())['error']}")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                yield json.loads(line)
+        finally:
+            writer.close()
+
+
+def serve(reference, host='127.0.0.1', port=8765, path=None, **options):
+    """Runs a JobServer until interrupted; options are passed to it."""
+    async def run():
+        server = await JobServer(reference, **options).start(
+            host, port, path)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+    asyncio.run(run())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reference', nargs='+', default=['pg74880.txt'],
+                        help='reference texts the model is trained on')
+    parser.add_argument('--order', type=int, default=2)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None,
+                        help='listen on this Unix socket path instead')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--p', type=float, default=0.5)
+    parser.add_argument('--max-queue', type=int, default=0,
+                        help='refuse jobs beyond this many waiting; '
+                             '0 for no limit')
+    args = parser.parse_args(argv)
+
+    reference = ''.join(load_corpus(path) for path in args.reference)
+    print(f"Serving on {args.unix or f'{args.host}:{args.port}'}")
+    try:
+        serve(reference, args.host, args.port, args.unix, order=args.order,
+              iterations=args.iterations, p=args.p,
+              processes=args.processes, max_queue=args.max_queue)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
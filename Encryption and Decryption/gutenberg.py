@@ -1,4 +1,5 @@
 from mcmc_decryptor import (
+    load_corpus,
     preprocess_text,
     generate_encryption_key,
     encrypt_text,
@@ -8,8 +9,7 @@ from mcmc_decryptor import (
 import matplotlib.pyplot as plt
 
 # Load the reference book (pg74880.txt) and the sample text
-with open("pg74880.txt", "r", errors="ignore") as file:
-    reference_text = file.read()
+reference_text_processed = load_corpus("pg74880.txt")
 
 sample_text = """
 Those who have taken the trouble to read the book in which the stories
@@ -22,7 +22,6 @@ the Son of Ben Ali, and knew the language of animals.
 """
 
 plaintext = preprocess_text(sample_text)
-reference_text_processed = preprocess_text(reference_text)
 
 encryption_key = generate_encryption_key()
 encrypted_text = encrypt_text(plaintext, encryption_key)
@@ -1,11 +1,19 @@
-import matplotlib.pyplot as plt
-from mcmc_decryptor import (
+import argparse
+import itertools
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
+from mcmc_decryptor import (  # noqa: E402
+    load_corpus,
     preprocess_text,
     generate_encryption_key,
     encrypt_text,
     metropolis_sampler_with_logs,
     apply_decryption,
+    build_count_store,
 )
+from sweep import evaluate_correctness, grid, plot_sweep, run_sweep  # noqa
 
 
 # Load sample texts for experiments
@@ -23,19 +31,6 @@ Sheikh Hussein ibn Juban to the governorship of Fars, a lucrative and
 much-coveted post.
 """
 
-# Load pg74880.txt as reference text
-with open("pg74880.txt", "r", encoding="utf-8") as f:
-    reference_text = f.read()
-
-# Preprocess the reference text (pg74880.txt)
-reference_text = preprocess_text(reference_text)
-
-
-def evaluate_correctness(decrypted_text, plaintext):
-    return sum(
-        1 for a, b in zip(decrypted_text, plaintext)
-        if a == b) / len(plaintext)
-
 
 # Cross-book analysis with (pg74880.txt)
 def experiment_single_reference(book_1_text, reference_text):
@@ -55,94 +50,107 @@ def experiment_single_reference(book_1_text, reference_text):
     plt.xlabel("Iteration")
     plt.ylabel("Log Likelihood")
     plt.grid()
-    plt.show()
+    plt.savefig("q5_cross_book_analysis.png")
+    plt.close()
 
 
-def experiment_text_length(book_text, reference_text):
-    lengths = [50, 100, 200, 400]
-    correctness_results = []
-    plaintext = preprocess_text(book_text)
-    for length in lengths:
-        short_text = plaintext[:length]
-        encryption_key = generate_encryption_key()
-        encrypted_text = encrypt_text(short_text, encryption_key)
-        decryption_key, _ = metropolis_sampler_with_logs(
-            encrypted_text, short_text, iterations=5000, p=0.8
-        )
-        decrypted_text = apply_decryption(decryption_key, encrypted_text)
-        correctness = evaluate_correctness(decrypted_text, short_text)
-        correctness_results.append((length, correctness))
-    for length, correctness in correctness_results:
-        print(f"Text Length: {length}, "
+# Cross-book analysis over every subset of the reference books
+def experiment_reference_subsets(book_1_text, store, seeds=range(3)):
+    plaintext = preprocess_text(book_1_text)
+    # Every subset decrypts the same ciphertexts
+    encrypted_texts = [encrypt_text(plaintext, generate_encryption_key())
+                       for _ in seeds]
+    results = []
+    for size in range(1, len(store) + 1):
+        for books in itertools.combinations(store.names, size):
+            model = store.model(books)
+            correctness = []
+            for seed, encrypted_text in zip(seeds, encrypted_texts):
+                decryption_key, _ = metropolis_sampler_with_logs(
+                    encrypted_text, model, iterations=5000, p=0.8,
+                    seed=seed)
+                correctness.append(evaluate_correctness(
+                    apply_decryption(decryption_key, encrypted_text),
+                    plaintext))
+            results.append((sum(correctness) / len(correctness), books))
+
+    print("Cross-book (Reference Subsets) analysis results:")
+    for correctness, books in sorted(results, reverse=True):
+        print(f"{' + '.join(books)}: "
               f"Decryption Correctness: {correctness:.2%}")
-
-    lengths, correctness = zip(*correctness_results)
-    plt.plot(lengths, correctness)
-    plt.title("Decryption Correctness vs. Text Length (Single Reference)")
-    plt.xlabel("Text Length")
-    plt.ylabel("Decryption Correctness")
-    plt.grid()
-    plt.show()
+    return results
 
 
-def experiment_tuning_p(book_text, reference_text):
-    p_values = [0.1, 0.5, 0.8, 0.95]
-    correctness_results = []
-    plaintext = preprocess_text(book_text)
-    encryption_key = generate_encryption_key()
-    encrypted_text = encrypt_text(plaintext, encryption_key)
-    for p in p_values:
-        decryption_key, _ = metropolis_sampler_with_logs(
-            encrypted_text, reference_text, iterations=5000, p=p
-        )
-        decrypted_text = apply_decryption(decryption_key, encrypted_text)
-        correctness = evaluate_correctness(decrypted_text, plaintext)
-        correctness_results.append((p, correctness))
-    for p, correctness in correctness_results:
-        print(f"p: {p}, Decryption Correctness: {correctness:.2%}")
-    p_values, correctness = zip(*correctness_results)
-    plt.plot(p_values, correctness)
-    plt.title("Decryption Correctness vs. p (Single Reference)")
-    plt.xlabel("p (Proposal Acceptance Ratio)")
-    plt.ylabel("Decryption Correctness")
-    plt.grid()
-    plt.show()
+def _report(rows, parameter, label):
+    for row in rows:
+        print(f"{label}: {row[parameter]}, seed {row['seed']}, "
+              f"Decryption Correctness: {row['correctness']:.2%}")
 
 
-def experiment_iterations(book_text, reference_text):
-    iterations_values = [500, 1000, 5000, 10000]
-    correctness_results = []
+def experiment_text_length(book_text, seeds=range(3), **sweep_options):
     plaintext = preprocess_text(book_text)
-    encryption_key = generate_encryption_key()
-    encrypted_text = encrypt_text(plaintext, encryption_key)
-    for iterations in iterations_values:
-        decryption_key, _ = metropolis_sampler_with_logs(
-            encrypted_text, reference_text, iterations=iterations, p=0.8
-        )
-        decrypted_text = apply_decryption(decryption_key, encrypted_text)
-        correctness = evaluate_correctness(decrypted_text, plaintext)
-        correctness_results.append((iterations, correctness))
-    for iterations, correctness in correctness_results:
-        print(f"Iterations: {iterations}, "
-              f"Decryption Correctness: {correctness:.2%}")
+    rows = run_sweep(grid(length=[50, 100, 200, 400], seed=seeds),
+                     plaintext, **sweep_options)
+    _report(rows, 'length', "Text Length")
+    plot_sweep(rows, 'length', "q5_text_length.png",
+               "Decryption Correctness vs. Text Length (Single Reference)",
+               "Text Length")
 
-    iterations, correctness = zip(*correctness_results)
-    plt.plot(iterations, correctness)
-    plt.title("Decryption Correctness vs. Iterations (Single Reference)")
-    plt.xlabel("Iterations")
-    plt.ylabel("Decryption Correctness")
-    plt.grid()
-    plt.show()
-
-
-print("Running Experiment (Single Reference Text - pg74880.txt)...")
-experiment_single_reference(book_1_text, reference_text)
 
-print("\nRunning Experiment (Text Length)...")
-experiment_text_length(book_1_text, reference_text)
+def experiment_tuning_p(book_text, seeds=range(3), **sweep_options):
+    plaintext = preprocess_text(book_text)
+    rows = run_sweep(grid(p=[0.1, 0.5, 0.8, 0.95], seed=seeds),
+                     plaintext, **sweep_options)
+    _report(rows, 'p', "p")
+    plot_sweep(rows, 'p', "q5_tuning_p.png",
+               "Decryption Correctness vs. p (Single Reference)",
+               "p (Proposal Acceptance Ratio)")
 
-print("\nRunning Experiment (Tuning p)...")
-experiment_tuning_p(book_1_text, reference_text)
 
-print("\nRunning Experiment (Iterations required)...")
-experiment_iterations(book_1_text, reference_text)
+def experiment_iterations(book_text, seeds=range(3), **sweep_options):
+    plaintext = preprocess_text(book_text)
+    rows = run_sweep(
+        grid(iterations=[500, 1000, 5000, 10000], seed=seeds),
+        plaintext, **sweep_options)
+    _report(rows, 'iterations', "Iterations")
+    plot_sweep(rows, 'iterations', "q5_iterations.png",
+               "Decryption Correctness vs. Iterations (Single Reference)",
+               "Iterations")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs the decryption experiments and saves the plots.")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache-dir', default='sweep_cache')
+    parser.add_argument('--seeds', type=int, default=3)
+    parser.add_argument('--count-store', default='count_store.npz',
+                        help='per-book bigram counts of the pg7488x books')
+    args = parser.parse_args(argv)
+    sweep_options = {'processes': args.processes,
+                     'cache_dir': args.cache_dir,
+                     'seeds': range(args.seeds)}
+
+    # Load and preprocess pg74880.txt as reference text
+    reference_text = load_corpus("pg74880.txt")
+
+    print("Running Experiment (Single Reference Text - pg74880.txt)...")
+    experiment_single_reference(book_1_text, reference_text)
+
+    print("\nRunning Experiment (Reference Subsets)...")
+    store = build_count_store(args.count_store, "pg7488[0-4].txt",
+                              processes=args.processes)
+    experiment_reference_subsets(book_1_text, store, range(args.seeds))
+
+    print("\nRunning Experiment (Text Length)...")
+    experiment_text_length(book_1_text, **sweep_options)
+
+    print("\nRunning Experiment (Tuning p)...")
+    experiment_tuning_p(book_1_text, **sweep_options)
+
+    print("\nRunning Experiment (Iterations required)...")
+    experiment_iterations(book_1_text, **sweep_options)
+
+
+if __name__ == "__main__":
+    main()
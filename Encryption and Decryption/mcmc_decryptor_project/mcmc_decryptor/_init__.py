@@ -1,21 +1,124 @@
 from .decryption import (
+    SYMBOLS,
+    LETTER_PAIRS,
+    MODEL_CACHE,
+    ModelCache,
+    cached_model,
+    corpus_hash,
+    BigramModel,
+    NgramModel,
+    BigramScorer,
+    NgramScorer,
+    ngram_indices,
+    ConvergenceMonitor,
+    SCHEDULES,
+    cooling_schedule,
+    ReheatingSchedule,
+    TraceRecorder,
+    SamplerStats,
+    ProposalRandom,
+    encode_text,
+    bigram_count_table,
     preprocess_text,
+    load_corpus,
+    count_corpus_file,
+    corpus_files,
+    CorpusCounts,
+    train_corpus,
+    count_book,
+    CountStore,
+    build_count_store,
+    ciphertext_count_table,
     build_frequency_matrix,
     compute_log_likelihood,
+    compile_key,
     apply_decryption,
+    decrypt_file,
+    translate_file,
+    encrypt_file,
     random_swap,
+    key_to_permutation,
+    permutation_to_key,
+    swap_delta,
+    swap_deltas,
+    score_permutation,
+    frequency_rank_permutation,
+    greedy_refine,
+    initial_permutation,
+    steepest_ascent,
+    polish_key,
     metropolis_sampler_with_logs,
+    metropolis_sampler_with_counts,
+    decrypt_stream,
+    metropolis_sampler_multichain,
+    metropolis_sampler_parallel_restarts,
+    metropolis_sampler_parallel_tempering,
+    Decryptor,
     generate_encryption_key,
     encrypt_text,
 )
+from .server import DecryptionJob, JobClient, JobServer, serve
 
 __all__ = [
+    "SYMBOLS",
+    "LETTER_PAIRS",
+    "MODEL_CACHE",
+    "ModelCache",
+    "cached_model",
+    "corpus_hash",
+    "BigramModel",
+    "NgramModel",
+    "BigramScorer",
+    "NgramScorer",
+    "ngram_indices",
+    "ConvergenceMonitor",
+    "SCHEDULES",
+    "cooling_schedule",
+    "ReheatingSchedule",
+    "TraceRecorder",
+    "SamplerStats",
+    "ProposalRandom",
+    "encode_text",
+    "bigram_count_table",
     "preprocess_text",
+    "load_corpus",
+    "count_corpus_file",
+    "corpus_files",
+    "CorpusCounts",
+    "train_corpus",
+    "count_book",
+    "CountStore",
+    "build_count_store",
+    "ciphertext_count_table",
     "build_frequency_matrix",
     "compute_log_likelihood",
+    "compile_key",
     "apply_decryption",
+    "decrypt_file",
+    "translate_file",
+    "encrypt_file",
     "random_swap",
+    "key_to_permutation",
+    "permutation_to_key",
+    "swap_delta",
+    "swap_deltas",
+    "score_permutation",
+    "frequency_rank_permutation",
+    "greedy_refine",
+    "initial_permutation",
+    "steepest_ascent",
+    "polish_key",
     "metropolis_sampler_with_logs",
+    "metropolis_sampler_with_counts",
+    "decrypt_stream",
+    "metropolis_sampler_multichain",
+    "metropolis_sampler_parallel_restarts",
+    "metropolis_sampler_parallel_tempering",
+    "Decryptor",
+    "DecryptionJob",
+    "JobServer",
+    "JobClient",
+    "serve",
     "generate_encryption_key",
     "encrypt_text",
 ]
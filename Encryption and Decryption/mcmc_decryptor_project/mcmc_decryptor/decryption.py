@@ -1,46 +1,1069 @@
+import codecs
+import cProfile
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pickle
 import random
+import shutil
 import string
+import sys
+import tempfile
+import time
 import numpy as np
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from multiprocessing import shared_memory
+
+
+SYMBOLS = string.ascii_lowercase + ' '
+FLOOR_PROBABILITY = 1e-6
+CACHE_DIR_ENV = 'MCMC_DECRYPTOR_CACHE'
+INSTRUMENT_ENV = 'MCMC_DECRYPTOR_INSTRUMENT'
+PROFILE_ENV = 'MCMC_DECRYPTOR_PROFILE'
+
+logger = logging.getLogger(__name__)
+
+_KEPT_BYTES = SYMBOLS.encode('ascii')
+_DROPPED_ASCII = bytes(
+    byte for byte in range(128) if byte not in _KEPT_BYTES)
+_LOWERCASE_BYTES = bytes.maketrans(
+    string.ascii_uppercase.encode('ascii'),
+    string.ascii_lowercase.encode('ascii'))
+_DROPPED_RAW_BYTES = bytes(
+    byte for byte in range(256)
+    if byte not in _KEPT_BYTES + string.ascii_uppercase.encode('ascii'))
+# The only non-ASCII characters whose lowercase contains ASCII letters
+# (U+0130 and U+212A), as UTF-8.
+_ASCII_LOWERING_UTF8 = ('\u0130'.encode('utf-8'), '\u212a'.encode('utf-8'))
+
+
+@lru_cache(maxsize=64)
+def _symbol_lookup(symbols):
+    """Builds a code point to symbol code lookup array for an alphabet."""
+    other = len(symbols)
+    dtype = np.uint8 if other < 256 else np.intp
+    lookup = np.full(max(map(ord, symbols)) + 2, other, dtype=dtype)
+    for code, char in enumerate(symbols):
+        lookup[ord(char)] = code
+    return lookup
+
+
+def encode_text(text, symbols=SYMBOLS):
+    """Encodes text as symbol codes; characters outside the alphabet
+    share the final code len(symbols)."""
+    lookup = _symbol_lookup(symbols)
+    if text.isascii():
+        points = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    else:
+        points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    return lookup[np.minimum(points, len(lookup) - 1)]
+
+
+def bigram_count_table(codes, size=len(SYMBOLS) + 1):
+    """Counts the bigrams of encoded text into a size x size table."""
+    codes = np.asarray(codes, dtype=np.intp)
+    pairs = codes[:-1] * size + codes[1:]
+    return np.bincount(pairs, minlength=size * size).reshape(size, size)
+
+
+class BigramModel:
+    """Dense table of bigram log probabilities over a symbol alphabet.
+
+    The table has one extra row and column for characters outside the
+    alphabet, which always score at the floor probability."""
+
+    order = 2
+
+    def __init__(self, log_probs, symbols=SYMBOLS):
+        self.symbols = symbols
+        self.size = len(symbols) + 1
+        self.log_probs = np.asarray(log_probs, dtype=np.float64)
+        if self.log_probs.shape != (self.size, self.size):
+            raise ValueError(
+                f"Expected a {self.size}x{self.size} table, "
+                f"got {self.log_probs.shape}")
+
+    @classmethod
+    def from_counts(cls, counts, symbols=SYMBOLS):
+        """Builds a model from a table of bigram counts."""
+        counts = np.asarray(counts)
+        probabilities = counts / max(counts.sum(), 1)
+        return cls._floored(probabilities, symbols)
+
+    @classmethod
+    def from_text(cls, reference_text, symbols=SYMBOLS):
+        """Builds a model from the bigrams of a reference text."""
+        counts = bigram_count_table(
+            encode_text(reference_text, symbols), len(symbols) + 1)
+        return cls.from_counts(counts, symbols)
+
+    @classmethod
+    def from_frequency_matrix(cls, frequency_matrix, symbols=SYMBOLS):
+        """Compiles a build_frequency_matrix dict into a model.
+
+        Characters of the dict outside symbols, such as punctuation or
+        newlines of unpreprocessed text, are appended to the model's
+        alphabet so that their bigrams keep their probabilities."""
+        extra = {char for pair in frequency_matrix for char in pair}
+        symbols += ''.join(sorted(extra - set(symbols)))
+        index = {char: code for code, char in enumerate(symbols)}
+        probabilities = np.zeros((len(symbols) + 1,) * 2)
+        for (first, second), probability in frequency_matrix.items():
+            probabilities[index[first], index[second]] = probability
+        return cls._floored(probabilities, symbols)
+
+    @classmethod
+    def _floored(cls, probabilities, symbols):
+        log_probs = np.log(np.maximum(probabilities, FLOOR_PROBABILITY))
+        log_probs[-1, :] = log_probs[:, -1] = np.log(FLOOR_PROBABILITY)
+        return cls(log_probs, symbols)
+
+    def entropy(self):
+        """Entropy in nats per bigram of the model's bigram distribution,
+        ignoring cells at the floor probability."""
+        seen = self.log_probs > np.log(FLOOR_PROBABILITY)
+        return -(np.exp(self.log_probs[seen]) * self.log_probs[seen]).sum()
+
+    def unigram_frequencies(self):
+        """Probability of each symbol code as the first of a bigram."""
+        return np.exp(self.log_probs).sum(axis=1)
+
+    def encode(self, text):
+        """Encodes text as symbol codes of this model."""
+        return encode_text(text, self.symbols)
+
+    def count_table(self, text):
+        """Counts the bigrams of the text into a table of symbol codes."""
+        return bigram_count_table(self.encode(text), self.size)
+
+    def score_codes(self, codes):
+        """Log likelihood of already encoded text."""
+        return self.log_probs[codes[:-1], codes[1:]].sum()
+
+    def score(self, text):
+        """Log likelihood of the text under the model."""
+        return self.score_codes(self.encode(text))
+
+    def scorer(self, encrypted_text):
+        """Returns a BigramScorer for permutations of the ciphertext."""
+        return BigramScorer(
+            self.log_probs, self.count_table(encrypted_text))
+
+
+def ngram_indices(codes, order, size=len(SYMBOLS) + 1):
+    """Flat table index of every n-gram of encoded text."""
+    codes = np.asarray(codes, dtype=np.intp)
+    windows = len(codes) - order + 1
+    if windows < 1:
+        return np.zeros(0, dtype=np.intp)
+    flat = codes[:windows].copy()
+    for offset in range(1, order):
+        flat *= size
+        flat += codes[offset:offset + windows]
+    return flat
+
+
+class NgramModel:
+    """Dense float32 table of n-gram log probabilities, such as trigrams
+    (order 3) or quadgrams (order 4), over a symbol alphabet.
+
+    As in BigramModel, n-grams that contain a character outside the
+    alphabet score at the floor probability."""
+
+    def __init__(self, log_probs, symbols=SYMBOLS):
+        self.symbols = symbols
+        self.size = len(symbols) + 1
+        self.log_probs = np.asarray(log_probs, dtype=np.float32)
+        self.order = self.log_probs.ndim
+        if self.log_probs.shape != (self.size,) * self.order:
+            raise ValueError(
+                f"Expected a table with sides of {self.size}, "
+                f"got {self.log_probs.shape}")
+
+    @classmethod
+    def from_counts(cls, counts, symbols=SYMBOLS):
+        """Builds a model from a dense table of n-gram counts."""
+        counts = np.asarray(counts)
+        probabilities = counts / max(counts.sum(), 1)
+        log_probs = np.log(np.maximum(probabilities, FLOOR_PROBABILITY))
+        for axis in range(counts.ndim):
+            index = [slice(None)] * counts.ndim
+            index[axis] = -1
+            log_probs[tuple(index)] = np.log(FLOOR_PROBABILITY)
+        return cls(log_probs, symbols)
+
+    @classmethod
+    def from_text(cls, reference_text, order=3, symbols=SYMBOLS):
+        """Builds a model from the n-grams of a reference text."""
+        size = len(symbols) + 1
+        flat = ngram_indices(
+            encode_text(reference_text, symbols), order, size)
+        counts = np.bincount(flat, minlength=size ** order)
+        return cls.from_counts(counts.reshape((size,) * order), symbols)
+
+    def entropy(self):
+        """Entropy in nats per n-gram, ignoring floored cells."""
+        log_probs = self.log_probs.astype(np.float64)
+        seen = log_probs > np.log(FLOOR_PROBABILITY) + 1e-6
+        return -(np.exp(log_probs[seen]) * log_probs[seen]).sum()
+
+    def unigram_frequencies(self):
+        """Probability of each symbol code as the first of an n-gram."""
+        return np.exp(self.log_probs.astype(np.float64)).sum(
+            axis=tuple(range(1, self.order)))
+
+    def encode(self, text):
+        """Encodes text as symbol codes of this model."""
+        return encode_text(text, self.symbols)
+
+    def score_codes(self, codes):
+        """Log likelihood of already encoded text."""
+        flat = ngram_indices(codes, self.order, self.size)
+        return self.log_probs.ravel()[flat].sum(dtype=np.float64)
+
+    def score(self, text):
+        """Log likelihood of the text under the model."""
+        return self.score_codes(self.encode(text))
+
+    def scorer(self, encrypted_text):
+        """Returns an NgramScorer for permutations of the ciphertext."""
+        return NgramScorer(self.log_probs, self.encode(encrypted_text))
+
+
+def corpus_hash(*texts, symbols=SYMBOLS):
+    """Content hash identifying a model built from the given texts."""
+    digest = hashlib.sha256(symbols.encode('utf-8'))
+    for text in texts:
+        data = text.encode('utf-8')
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _atomic_save(path, write):
+    """Writes a file through write(file) and moves it into place, so
+    readers never see a partial artifact."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        write(file)
+    os.replace(temporary, path)
+
+
+class ModelCache:
+    """In-process LRU of built models, optionally backed by files in a
+    cache directory (the cache_dir argument or the MCMC_DECRYPTOR_CACHE
+    environment variable). Without a directory nothing is written."""
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get_or_build(self, key, build, filename=None, load=None, save=None,
+                     cache_dir=None):
+        """Returns the cached value for key, loading it from
+        cache_dir/filename or calling build() when it is missing."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+        path = None
+        if cache_dir and filename:
+            path = os.path.join(cache_dir, filename)
+        if path is not None and os.path.exists(path):
+            value = load(path)
+        else:
+            value = build()
+            if path is not None:
+                _atomic_save(path, lambda file: save(file, value))
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Forgets the in-process entries; files on disk are kept."""
+        self._entries.clear()
+
+
+MODEL_CACHE = ModelCache()
+
+
+def cached_model(reference_text, symbols=SYMBOLS, cache_dir=None, order=2):
+    """Returns the BigramModel (or NgramModel for order above 2) of a
+    preprocessed reference text, reusing an in-process copy or a
+    memory-mapped .npy table from the cache directory when the same
+    corpus was compiled before."""
+    key = corpus_hash(reference_text, symbols=symbols)
+    if order == 2:
+        return MODEL_CACHE.get_or_build(
+            ('bigram', key),
+            lambda: BigramModel.from_text(reference_text, symbols),
+            filename=f'bigram-{key}.npy',
+            load=lambda path: BigramModel(
+                np.load(path, mmap_mode='r'), symbols),
+            save=lambda file, model: np.save(file, model.log_probs),
+            cache_dir=cache_dir)
+    return MODEL_CACHE.get_or_build(
+        ('ngram', order, key),
+        lambda: NgramModel.from_text(reference_text, order, symbols),
+        filename=f'ngram{order}-{key}.npy',
+        load=lambda path: NgramModel(np.load(path, mmap_mode='r'), symbols),
+        save=lambda file, model: np.save(file, model.log_probs),
+        cache_dir=cache_dir)
+
+
+def _as_model(reference, order=2):
+    """Accepts a compiled BigramModel or NgramModel or a reference text."""
+    if isinstance(reference, (BigramModel, NgramModel)):
+        return reference
+    return cached_model(reference, order=order)
 
 
 def preprocess_text(text):
     """Converts text to lowercase and removes special
     characters except spaces."""
     text = text.lower()
-    text = ''.join(
-        char for char in text if char in string.ascii_lowercase or char == ' ')
-    return text
+    return text.encode('ascii', 'ignore').translate(
+        None, _DROPPED_ASCII).decode('ascii')
+
+
+def load_corpus(path):
+    """Reads and preprocesses a UTF-8 text file like
+    preprocess_text(open(path).read()), working on the raw bytes instead
+    of decoding the file."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if any(sequence in data for sequence in _ASCII_LOWERING_UTF8):
+        return preprocess_text(data.decode('utf-8', 'ignore'))
+    return data.translate(
+        _LOWERCASE_BYTES, _DROPPED_RAW_BYTES).decode('ascii')
 
 
 def build_frequency_matrix(reference_text):
     """Builds a frequency matrix for bigrams from the reference text."""
     frequency_matrix = defaultdict(int)
-    for i in range(len(reference_text) - 1):
-        bigram = (reference_text[i], reference_text[i + 1])
-        frequency_matrix[bigram] += 1
+    total = len(reference_text) - 1
+    if total < 1:
+        return frequency_matrix
 
-    total = sum(frequency_matrix.values())
-    for key in frequency_matrix:
-        frequency_matrix[key] /= total
+    codes = encode_text(reference_text)
+    if codes.max() < len(SYMBOLS):
+        counts = bigram_count_table(codes)
+        firsts, seconds = np.nonzero(counts)
+        for first, second, count in zip(
+                firsts.tolist(), seconds.tolist(),
+                counts[firsts, seconds].tolist()):
+            frequency_matrix[(SYMBOLS[first], SYMBOLS[second])] = (
+                count / total)
+        return frequency_matrix
 
+    points = np.frombuffer(
+        reference_text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    pairs, counts = np.unique(
+        (points[:-1] << np.uint64(32)) | points[1:], return_counts=True)
+    for pair, count in zip(pairs.tolist(), counts.tolist()):
+        frequency_matrix[(chr(pair >> 32), chr(pair & 0xFFFFFFFF))] = (
+            count / total)
     return frequency_matrix
 
 
+CORPUS_CHUNK_SIZE = 1 << 20
+
+
+def _count_corpus_ngrams(path, orders, chunk_size=CORPUS_CHUNK_SIZE):
+    """Counts the n-grams of every order of a preprocessed UTF-8 file,
+    reading it in chunks of chunk_size bytes. Returns a dict of count
+    tables by order, the number of preprocessed characters and the
+    SHA-256 of the preprocessed text.
+
+    The last characters of each chunk are carried into the next one, so
+    n-grams that span chunk boundaries are counted exactly once."""
+    size = len(SYMBOLS) + 1
+    tables = {order: np.zeros(size ** order, dtype=np.int64)
+              for order in orders}
+    context = max(orders) - 1
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    digest = hashlib.sha256()
+    characters = 0
+    carry = ''
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            new_text = preprocess_text(decoder.decode(chunk, final=not chunk))
+            characters += len(new_text)
+            digest.update(new_text.encode('ascii'))
+            text = carry + new_text
+            codes = encode_text(text)
+            for order, table in tables.items():
+                # Skip the n-grams that lie wholly inside the carry
+                first = max(len(carry) - order + 1, 0)
+                table += np.bincount(
+                    ngram_indices(codes[first:], order, size),
+                    minlength=size ** order)
+            carry = text[-context:] if context else ''
+            if not chunk:
+                break
+    return ({order: table.reshape((size,) * order)
+             for order, table in tables.items()},
+            characters, digest.hexdigest())
+
+
+def count_corpus_file(path, chunk_size=CORPUS_CHUNK_SIZE, order=2):
+    """Counts the bigrams (or n-grams of a higher order) of a
+    preprocessed UTF-8 file into a table of symbol codes, reading it in
+    chunks of chunk_size bytes.
+
+    N-grams that span chunk boundaries are counted exactly as in
+    bigram_count_table(encode_text(load_corpus(path)))."""
+    tables, _, _ = _count_corpus_ngrams(path, (order,), chunk_size)
+    return tables[order]
+
+
+def corpus_files(source):
+    """Expands a directory (its .txt files), a glob pattern or a list of
+    paths into a sorted list of file paths."""
+    if isinstance(source, (list, tuple)):
+        return sorted(map(os.fspath, source))
+    source = os.fspath(source)
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, '*.txt')))
+    return sorted(glob.glob(source))
+
+
+def _map_files(task, tasks, processes=None):
+    """Yields task(args) for every args of tasks as they complete, on a
+    process pool unless there is a single task or processes is 1."""
+    if len(tasks) == 1 or processes == 1:
+        yield from map(task, tasks)
+    elif tasks:
+        with multiprocessing.Pool(processes) as pool:
+            yield from pool.imap_unordered(task, tasks)
+
+
+class CorpusCounts:
+    """Integer bigram counts merged over a growing set of corpus files.
+
+    Files are identified by absolute path, so adding a file that is
+    already included does not count it again."""
+
+    def __init__(self, counts=None, files=()):
+        size = len(SYMBOLS) + 1
+        if counts is None:
+            counts = np.zeros((size, size), dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.files = list(files)
+
+    def add_files(self, source, processes=None,
+                  chunk_size=CORPUS_CHUNK_SIZE):
+        """Counts the new files in source on a process pool and merges
+        their tables into the totals. Returns the files that were added."""
+        known = set(self.files)
+        new_files = [path for path in map(os.path.abspath,
+                                          corpus_files(source))
+                     if path not in known]
+        for table in _map_files(
+                _count_corpus_task,
+                [(path, chunk_size) for path in new_files], processes):
+            self.counts += table
+        self.files.extend(new_files)
+        return new_files
+
+    def model(self):
+        """Compiles the merged counts into a BigramModel."""
+        return BigramModel.from_counts(self.counts)
+
+    def save(self, path):
+        """Writes the counts and file list to an .npz file."""
+        _atomic_save(path, lambda file: np.savez(
+            file, counts=self.counts, files=np.array(self.files, dtype=str)))
+
+    @classmethod
+    def load(cls, path):
+        """Reads counts written by save."""
+        with np.load(path) as data:
+            return cls(data['counts'], data['files'].tolist())
+
+
+def _count_corpus_task(task):
+    path, chunk_size = task
+    return count_corpus_file(path, chunk_size)
+
+
+def train_corpus(source, processes=None, chunk_size=CORPUS_CHUNK_SIZE):
+    """Counts every corpus file of a directory, glob or path list in
+    parallel and returns the merged CorpusCounts."""
+    corpus = CorpusCounts()
+    corpus.add_files(source, processes, chunk_size)
+    return corpus
+
+
+GUTENBERG_FIELDS = ('Title', 'Author', 'Language')
+
+
+def _gutenberg_header(path, fields=GUTENBERG_FIELDS, limit=1 << 14):
+    """Reads the Title, Author and Language lines from the header of a
+    Project Gutenberg file, if it has them."""
+    with open(path, 'rb') as file:
+        head = file.read(limit).decode('utf-8', 'ignore')
+    header = {}
+    for line in head.splitlines():
+        name, _, value = line.partition(':')
+        if name in fields and value.strip() and name.lower() not in header:
+            header[name.lower()] = value.strip()
+    return header
+
+
+def count_book(path, orders=(2,), chunk_size=CORPUS_CHUNK_SIZE):
+    """Counts the n-grams of every order of one book in chunks, as
+    count_corpus_file does. Returns the book's metadata and a dict of
+    integer count tables by order."""
+    path = os.path.abspath(os.fspath(path))
+    status = os.stat(path)
+    tables, characters, sha256 = _count_corpus_ngrams(
+        path, orders, chunk_size)
+    book = {
+        'name': os.path.splitext(os.path.basename(path))[0],
+        'path': path,
+        'bytes': status.st_size,
+        'mtime_ns': status.st_mtime_ns,
+        'characters': characters,
+        'sha256': sha256,
+    }
+    book.update(_gutenberg_header(path))
+    return book, tables
+
+
+def _count_book_task(task):
+    path, orders, chunk_size = task
+    return count_book(path, orders, chunk_size)
+
+
+class CountStore:
+    """Integer n-gram count tables of individual books, kept side by side
+    so that a model of any subset or mixture of the books is a sum of
+    tables rather than a pass over their text.
+
+    Every book has a table for each of the store's orders (2 for bigrams,
+    3 for trigrams and so on) and a metadata dict with its name, path,
+    size, character count, the SHA-256 of its preprocessed text and, for
+    Project Gutenberg files, title, author and language. Books are
+    identified by absolute path and looked up by name, the file name
+    without its extension, which must therefore be unique in a store.
+    save writes all of it to one compressed .npz file."""
+
+    def __init__(self, orders=(2,), books=(), tables=None):
+        self.orders = tuple(sorted(orders))
+        self.books = [dict(book) for book in books]
+        self._index = {book['name']: row
+                       for row, book in enumerate(self.books)}
+        self._paths = {book['path']: row
+                       for row, book in enumerate(self.books)}
+        size = len(SYMBOLS) + 1
+        if tables is None:
+            tables = {order: np.zeros((0,) + (size,) * order, np.int64)
+                      for order in self.orders}
+        self.tables = {order: np.asarray(tables[order], dtype=np.int64)
+                       for order in self.orders}
+
+    @property
+    def names(self):
+        """Names of the stored books, in the order they were added."""
+        return [book['name'] for book in self.books]
+
+    def __len__(self):
+        return len(self.books)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def book(self, name):
+        """Metadata dict of the named book."""
+        return self.books[self._index[name]]
+
+    def _is_current(self, path):
+        row = self._paths.get(path)
+        if row is None:
+            return False
+        book = self.books[row]
+        status = os.stat(path)
+        return (book['bytes'] == status.st_size
+                and book['mtime_ns'] == status.st_mtime_ns)
+
+    def _check_name(self, name, path, names):
+        row = self._index.get(name)
+        if (row is not None and self.books[row]['path'] != path
+                or names.setdefault(name, path) != path):
+            raise ValueError(
+                f"Another book named {name} is already in the store")
+
+    def add_files(self, source, processes=None,
+                  chunk_size=CORPUS_CHUNK_SIZE):
+        """Counts the files in source (a directory, glob or list of
+        paths) that are new or have changed since they were stored, on
+        a process pool, and stores their tables. A changed file replaces
+        its stored book. Raises ValueError, before counting anything,
+        when two files would share a name. Books are stored in path
+        order, whichever finishes first. Returns the names of the books
+        that were (re)counted."""
+        paths = [path for path in map(os.path.abspath, corpus_files(source))
+                 if not self._is_current(path)]
+        names = {}
+        for path in paths:
+            self._check_name(os.path.splitext(os.path.basename(path))[0],
+                             path, names)
+        counted = sorted(
+            _map_files(_count_book_task,
+                       [(path, self.orders, chunk_size) for path in paths],
+                       processes),
+            key=lambda item: item[0]['path'])
+        for book, tables in counted:
+            self.add(book, tables)
+        return [book['name'] for book, _ in counted]
+
+    def add(self, book, tables):
+        """Stores one book's metadata and its table of every order,
+        replacing the stored book with the same path."""
+        name = book['name']
+        self._check_name(name, book['path'], {})
+        row = self._paths.get(book['path'])
+        if row is None:
+            row = len(self.books)
+            self.books.append(dict(book))
+            self._index[name] = row
+            self._paths[book['path']] = row
+            for order in self.orders:
+                self.tables[order] = np.concatenate(
+                    [self.tables[order], np.asarray(tables[order])[None]])
+        else:
+            self.books[row] = dict(book)
+            for order in self.orders:
+                self.tables[order][row] = tables[order]
+
+    def _rows(self, books):
+        if books is None:
+            return list(range(len(self.books)))
+        if isinstance(books, str):
+            books = [books]
+        return [self._index[name] for name in books]
+
+    def counts(self, books=None, order=2):
+        """Summed count table of the named books, or of all books.
+
+        books may also be a dict of mixture weights by book name, in
+        which case every book's table is first scaled to the same total
+        so the weights give each book's share of the mixture; the result
+        is then a float table."""
+        table = self.tables[order]
+        if not isinstance(books, dict):
+            rows = self._rows(books)
+            return table[rows].sum(axis=0)
+        rows = self._rows(list(books))
+        totals = table[rows].reshape(len(rows), -1).sum(axis=1)
+        weights = np.array(list(books.values()), dtype=np.float64)
+        return np.tensordot(weights / np.maximum(totals, 1), table[rows],
+                            axes=1)
+
+    def model(self, books=None, order=2):
+        """BigramModel (or NgramModel for order above 2) of the named
+        books or mixture weights, as in counts."""
+        counts = self.counts(books, order)
+        if order == 2:
+            return BigramModel.from_counts(counts)
+        return NgramModel.from_counts(counts)
+
+    def save(self, path):
+        """Writes the tables and metadata to a compressed .npz file."""
+        arrays = {f'order{order}': table
+                  for order, table in self.tables.items()}
+        metadata = json.dumps({'symbols': SYMBOLS, 'books': self.books})
+        _atomic_save(path, lambda file: np.savez_compressed(
+            file, metadata=np.array(metadata), **arrays))
+
+    @classmethod
+    def load(cls, path):
+        """Reads a store written by save."""
+        with np.load(path) as data:
+            metadata = json.loads(data['metadata'].item())
+            if metadata['symbols'] != SYMBOLS:
+                raise ValueError(
+                    f"{path} was counted over a different alphabet")
+            tables = {int(name[len('order'):]): data[name]
+                      for name in data.files if name.startswith('order')}
+        return cls(sorted(tables), metadata['books'], tables)
+
+
+def build_count_store(path, source=None, orders=(2,), processes=None):
+    """Loads the CountStore saved at path, or starts an empty one when
+    there is none or it holds other orders, counts the new or changed
+    files of source into it and saves it again if anything was counted."""
+    store = None
+    if os.path.exists(path):
+        store = CountStore.load(path)
+        if store.orders != tuple(sorted(orders)):
+            store = None
+    if store is None:
+        store = CountStore(orders)
+    if source is not None and store.add_files(source, processes):
+        store.save(path)
+    return store
+
+
+@contextmanager
+def _open_binary(source, mode='rb'):
+    """Opens a path as a binary file; '-' is stdin or stdout and an
+    already open file object is used as is."""
+    if source == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        yield stream.buffer
+    elif isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, mode) as file:
+            yield file
+    else:
+        yield getattr(source, 'buffer', source)
+
+
+def _read_text_chunks(source, chunk_size, errors='replace'):
+    """Yields the text of a UTF-8 source in chunks of about chunk_size
+    bytes, never splitting a character."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors=errors)
+    with _open_binary(source) as file:
+        while True:
+            chunk = file.read(chunk_size)
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                yield text
+            if not chunk:
+                return
+
+
+def ciphertext_count_table(source, chunk_size=CORPUS_CHUNK_SIZE,
+                           symbols=SYMBOLS):
+    """Counts the bigrams of a ciphertext file, file object or stdin
+    ('-') in chunks, without holding the whole message in memory.
+
+    The result equals BigramModel.count_table of the full text, which is
+    all the delta-scored sampler needs to score a key."""
+    size = len(symbols) + 1
+    counts = np.zeros((size, size), dtype=np.int64)
+    carry = ''
+    for text in _read_text_chunks(source, chunk_size):
+        text = carry + text
+        counts += bigram_count_table(encode_text(text, symbols), size)
+        carry = text[-1:]
+    return counts
+
+
 def compute_log_likelihood(decryption, encrypted_text, frequency_matrix):
-    """Computes the log likelihood of a decryption mapping."""
-    decrypted_text = apply_decryption(decryption, encrypted_text)
-    log_likelihood = 0
-    for i in range(len(decrypted_text) - 1):
-        bigram = (decrypted_text[i], decrypted_text[i + 1])
-        bigram_probability = max(frequency_matrix.get(bigram, 0), 1e-6)
-        log_likelihood += np.log(bigram_probability)
-    return log_likelihood
+    """Computes the log likelihood of a decryption mapping.
+
+    frequency_matrix may be a build_frequency_matrix dict or an
+    already compiled BigramModel or NgramModel."""
+    if isinstance(frequency_matrix, (BigramModel, NgramModel)):
+        model = frequency_matrix
+    else:
+        model = BigramModel.from_frequency_matrix(frequency_matrix)
+    return model.score(apply_decryption(decryption, encrypted_text))
+
+
+def compile_key(key):
+    """Compiles a character mapping into a str.translate table.
+
+    apply_decryption and encrypt_text accept either form; compile a key
+    once when it is applied to many texts."""
+    return str.maketrans(key)
 
 
 def apply_decryption(decryption, encrypted_text):
     """Decrypts the encrypted text using the given decryption mapping."""
-    return ''.join(decryption.get(char, char) for char in encrypted_text)
+    return encrypted_text.translate(compile_key(decryption))
+
+
+def _byte_table(key):
+    """bytes.translate table for a mapping between single ASCII
+    characters, or None for any other mapping."""
+    key = {chr(char) if isinstance(char, int) else char: value
+           for char, value in key.items()}
+    if not all(char.isascii() and isinstance(value, str)
+               and len(value) == 1 and value.isascii()
+               for char, value in key.items()):
+        return None
+    return bytes.maketrans(''.join(key).encode('ascii'),
+                           ''.join(key.values()).encode('ascii'))
+
+
+def translate_file(key, source, destination, chunk_size=CORPUS_CHUNK_SIZE):
+    """Applies a character mapping to a UTF-8 path, file object or stdin
+    ('-') and streams the result to destination in fixed-size chunks.
+
+    A mapping between ASCII characters, such as any substitution key,
+    is applied to the raw bytes, since ASCII bytes never occur inside a
+    multi-byte UTF-8 sequence. Other mappings go through decoded text.
+    Either way bytes that are not valid UTF-8 are copied unchanged."""
+    table = _byte_table(key)
+    with _open_binary(destination, 'wb') as output:
+        if table is not None:
+            with _open_binary(source) as file:
+                for chunk in iter(lambda: file.read(chunk_size), b''):
+                    output.write(chunk.translate(table))
+            return
+        table = compile_key(key)
+        for text in _read_text_chunks(source, chunk_size,
+                                      errors='surrogateescape'):
+            output.write(
+                text.translate(table).encode('utf-8', 'surrogateescape'))
+
+
+def decrypt_file(decryption, source, destination,
+                 chunk_size=CORPUS_CHUNK_SIZE):
+    """Applies a decryption mapping to a ciphertext path, file object or
+    stdin ('-') and streams the result to destination chunk by chunk."""
+    translate_file(decryption, source, destination, chunk_size)
+
+
+def encrypt_file(encryption_key, source, destination,
+                 chunk_size=CORPUS_CHUNK_SIZE):
+    """Encrypts a plaintext path, file object or stdin ('-') with the
+    given key and streams the result to destination chunk by chunk."""
+    translate_file(encryption_key, source, destination, chunk_size)
+
+
+def key_to_permutation(decryption, symbols=SYMBOLS):
+    """Converts a decryption mapping into an array giving the plaintext
+    symbol code of every cipher symbol code. Letters missing from the
+    mapping decrypt to themselves, and the result must permute the
+    letters among themselves, or ValueError is raised."""
+    plain = np.arange(len(symbols) + 1)
+    for cipher_char, plain_char in decryption.items():
+        plain[symbols.index(cipher_char)] = symbols.index(plain_char)
+    letters = len(string.ascii_lowercase)
+    if not (np.array_equal(np.sort(plain[:letters]), np.arange(letters))
+            and np.array_equal(plain[letters:],
+                               np.arange(letters, len(plain)))):
+        raise ValueError(
+            "The decryption mapping must map letters one-to-one onto "
+            "letters")
+    return plain
+
+
+def permutation_to_key(plain, symbols=SYMBOLS):
+    """Converts a permutation array back into a letter decryption mapping."""
+    return {char: symbols[plain[code]]
+            for code, char in enumerate(string.ascii_lowercase)}
+
+
+def _local_log_likelihood(counts, log_probs, plain, a, b):
+    """Log likelihood of the bigrams that touch cipher codes a or b."""
+    plain_a = plain[a]
+    plain_b = plain[b]
+    total = (counts[a].dot(log_probs[plain_a].take(plain))
+             + counts[b].dot(log_probs[plain_b].take(plain))
+             + counts[:, a].dot(log_probs[:, plain_a].take(plain))
+             + counts[:, b].dot(log_probs[:, plain_b].take(plain)))
+    return total - (counts[a, a] * log_probs[plain_a, plain_a]
+                    + counts[a, b] * log_probs[plain_a, plain_b]
+                    + counts[b, a] * log_probs[plain_b, plain_a]
+                    + counts[b, b] * log_probs[plain_b, plain_b])
+
+
+def swap_delta(counts, log_probs, plain, a, b):
+    """Swaps the plaintext symbols of cipher codes a and b in place and
+    returns the change in log likelihood, computed from their rows and
+    columns of the ciphertext bigram count table only. Swap the same
+    codes again to revert."""
+    before = _local_log_likelihood(counts, log_probs, plain, a, b)
+    plain[a], plain[b] = plain[b], plain[a]
+    return _local_log_likelihood(counts, log_probs, plain, a, b) - before
+
+
+def _local_log_likelihoods(counts, log_probs, plain, a, b):
+    """Vectorized _local_log_likelihood for a stack of permutations,
+    one row of plain and one pair of codes per chain."""
+    size = log_probs.shape[1]
+    flat = log_probs.ravel()
+    chains = np.arange(len(plain))
+    plain_a = plain[chains, a]
+    plain_b = plain[chains, b]
+    row_a = plain_a[:, None] * size
+    row_b = plain_b[:, None] * size
+    columns = plain * size
+    total = (np.einsum('ij,ij->i', counts[a], flat.take(row_a + plain))
+             + np.einsum('ij,ij->i', counts[b], flat.take(row_b + plain))
+             + np.einsum('ij,ij->i', counts.T[a],
+                         flat.take(columns + plain_a[:, None]))
+             + np.einsum('ij,ij->i', counts.T[b],
+                         flat.take(columns + plain_b[:, None])))
+    return total - (counts[a, a] * flat.take(plain_a * size + plain_a)
+                    + counts[a, b] * flat.take(plain_a * size + plain_b)
+                    + counts[b, a] * flat.take(plain_b * size + plain_a)
+                    + counts[b, b] * flat.take(plain_b * size + plain_b))
+
+
+def _swap_rows(plain, a, b, chains):
+    """Swaps codes a and b in place in the given rows of plain."""
+    plain[chains, a], plain[chains, b] = plain[chains, b], plain[chains, a]
+
+
+def swap_deltas(counts, log_probs, plain, a, b):
+    """swap_delta for every row of a stack of permutations at once."""
+    chains = np.arange(len(plain))
+    before = _local_log_likelihoods(counts, log_probs, plain, a, b)
+    _swap_rows(plain, a, b, chains)
+    return _local_log_likelihoods(counts, log_probs, plain, a, b) - before
+
+
+def score_permutation(counts, log_probs, plain):
+    """Log likelihood of the decryption given by a permutation array,
+    computed from the ciphertext bigram count table."""
+    return (counts * log_probs[np.ix_(plain, plain)]).sum()
+
+
+class BigramScorer:
+    """Scores permutations of one ciphertext from its bigram count
+    table; see swap_delta."""
+
+    def __init__(self, log_probs, counts):
+        self.log_probs = log_probs
+        self.counts = np.asarray(counts, dtype=np.float64)
+
+    def score(self, plain):
+        """Log likelihood of the decryption given by plain."""
+        return score_permutation(self.counts, self.log_probs, plain)
+
+    def swap_delta(self, plain, a, b):
+        """Swaps codes a and b of plain in place and returns the change
+        in log likelihood."""
+        return swap_delta(self.counts, self.log_probs, plain, a, b)
+
+    def pair_deltas(self, plain, a, b):
+        """Change in log likelihood of each swap of codes a[i] and b[i]
+        on its own, in one vectorized operation; plain is unchanged."""
+        return swap_deltas(self.counts, self.log_probs,
+                           np.tile(plain, (len(a), 1)), a, b)
+
+
+class NgramScorer:
+    """Scores permutations of one ciphertext under an n-gram table.
+
+    The ciphertext is reduced to its distinct n-grams and their counts.
+    A swap only rescores the distinct n-grams that contain one of the
+    two swapped symbols, so its cost is bounded by the number of
+    possible n-grams rather than by the length of the ciphertext."""
+
+    def __init__(self, log_probs, codes):
+        order = log_probs.ndim
+        size = log_probs.shape[0]
+        flat, counts = np.unique(
+            ngram_indices(codes, order, size), return_counts=True)
+        self.ngrams = np.stack(
+            np.unravel_index(flat, (size,) * order), axis=1)
+        self.counts = counts.astype(np.float64)
+        self.flat_log_probs = log_probs.ravel()
+        self.strides = size ** np.arange(order - 1, -1, -1)
+        self.masks = np.bitwise_or.reduce(
+            np.left_shift(1, self.ngrams), axis=1)
+        self.rows = [np.flatnonzero((self.masks >> code) & 1)
+                     for code in range(size)]
+        self._pair_rows = {}
+
+    def _rows(self, a, b):
+        key = (a, b) if a < b else (b, a)
+        rows = self._pair_rows.get(key)
+        if rows is None:
+            rows_b = self.rows[b]
+            rows = np.concatenate(
+                [self.rows[a], rows_b[((self.masks[rows_b] >> a) & 1) == 0]])
+            self._pair_rows[key] = rows
+        return rows
+
+    def _log_probs(self, plain, ngrams):
+        return self.flat_log_probs.take(plain.take(ngrams) @ self.strides)
+
+    def score(self, plain):
+        """Log likelihood of the decryption given by plain."""
+        return self.counts.dot(self._log_probs(plain, self.ngrams))
+
+    def swap_delta(self, plain, a, b):
+        """Swaps codes a and b of plain in place and returns the change
+        in log likelihood."""
+        rows = self._rows(a, b)
+        ngrams = self.ngrams[rows]
+        counts = self.counts[rows]
+        before = counts.dot(self._log_probs(plain, ngrams))
+        plain[a], plain[b] = plain[b], plain[a]
+        return counts.dot(self._log_probs(plain, ngrams)) - before
+
+    def pair_deltas(self, plain, a, b):
+        """Change in log likelihood of each swap of codes a[i] and b[i]
+        on its own; plain is unchanged."""
+        deltas = np.empty(len(a))
+        for i, (code_a, code_b) in enumerate(zip(a.tolist(), b.tolist())):
+            deltas[i] = self.swap_delta(plain, code_a, code_b)
+            plain[code_a], plain[code_b] = plain[code_b], plain[code_a]
+        return deltas
+
+
+class ProposalRandom:
+    """Seedable source of Metropolis proposals and acceptance draws.
+
+    Swap pairs of distinct codes below letters and log-uniform
+    acceptance thresholds are drawn from a NumPy Generator in blocks of
+    block_size, so a proposal is accepted when its log acceptance ratio
+    exceeds the threshold, without calling exp. seed may be an int, a
+    numpy.random.Generator or None, which seeds from the random module
+    so that random.seed() still makes runs reproducible.
+
+    getstate and setstate capture and restore the generator together
+    with the unused part of the current block."""
+
+    def __init__(self, seed=None, letters=len(string.ascii_lowercase),
+                 block_size=4096):
+        if isinstance(seed, np.random.Generator):
+            self.generator = seed
+        else:
+            if seed is None:
+                seed = random.getrandbits(64)
+            self.generator = np.random.default_rng(seed)
+        self.letters = letters
+        self.block_size = block_size
+        self._block = []
+        self._index = 0
+
+    def _refill(self):
+        a = self.generator.integers(self.letters, size=self.block_size)
+        b = self.generator.integers(self.letters - 1, size=self.block_size)
+        b += b >= a
+        thresholds = -self.generator.standard_exponential(self.block_size)
+        self._block = list(zip(a.tolist(), b.tolist(), thresholds.tolist()))
+        self._index = 0
+
+    def draw(self):
+        """Returns the next (a, b, log_threshold) proposal."""
+        if self._index == len(self._block):
+            self._refill()
+        draw = self._block[self._index]
+        self._index += 1
+        return draw
+
+    def permutation(self, n=None):
+        """A random permutation of the codes below n (letters by default)
+        as a list."""
+        return self.generator.permutation(
+            self.letters if n is None else n).tolist()
+
+    def getstate(self):
+        return (self.generator.bit_generator.state,
+                self._block[self._index:])
+
+    def setstate(self, state):
+        self.generator.bit_generator.state, self._block = state
+        self._block = list(self._block)
+        self._index = 0
 
 
 def random_swap(decryption):
@@ -51,40 +1074,1120 @@ def random_swap(decryption):
     return new_decryption
 
 
+def frequency_rank_permutation(cipher_frequencies, reference_frequencies):
+    """Permutation that decrypts the n-th most frequent cipher letter as
+    the n-th most frequent letter of the reference. Both arguments hold
+    one count or probability per symbol code; codes after the letters
+    stay fixed."""
+    letters = len(string.ascii_lowercase)
+    plain = np.arange(len(reference_frequencies))
+    cipher_ranking = np.argsort(
+        -np.asarray(cipher_frequencies[:letters]), kind='stable')
+    plain_ranking = np.argsort(
+        -np.asarray(reference_frequencies[:letters]), kind='stable')
+    plain[cipher_ranking] = plain_ranking
+    return plain
+
+
+def greedy_refine(scorer, plain, passes=1):
+    """Tries every swap of two letters in turn, keeping the ones that
+    raise the score, for up to passes passes over all pairs; plain is
+    modified in place and returned."""
+    letters = len(string.ascii_lowercase)
+    for _ in range(passes):
+        improved = False
+        for a in range(letters - 1):
+            for b in range(a + 1, letters):
+                if scorer.swap_delta(plain, a, b) > 0:
+                    improved = True
+                else:
+                    plain[a], plain[b] = plain[b], plain[a]
+        if not improved:
+            break
+    return plain
+
+
+LETTER_PAIRS = np.triu_indices(len(string.ascii_lowercase), 1)
+
+
+def steepest_ascent(scorer, plain, max_swaps=1000):
+    """Repeatedly applies the letter swap that raises the score most,
+    found by scoring all 325 swaps at once, until no swap improves it.
+    plain is modified in place and at most max_swaps swaps are applied.
+
+    Returns plain, the total gain in log likelihood and the number of
+    swaps applied."""
+    a, b = LETTER_PAIRS
+    gain = 0.0
+    swaps = 0
+    while swaps < max_swaps:
+        deltas = scorer.pair_deltas(plain, a, b)
+        best = int(np.argmax(deltas))
+        if deltas[best] <= 1e-9:
+            break
+        plain[a[best]], plain[b[best]] = plain[b[best]], plain[a[best]]
+        gain += deltas[best]
+        swaps += 1
+    return plain, gain, swaps
+
+
+def polish_key(decryption, encrypted_text, reference_text, order=2):
+    """Runs steepest_ascent from a decryption mapping, such as the best
+    key of metropolis_sampler_with_logs, and returns the polished
+    mapping."""
+    model = _as_model(reference_text, order)
+    plain = key_to_permutation(decryption, model.symbols)
+    steepest_ascent(model.scorer(encrypted_text), plain)
+    return permutation_to_key(plain, model.symbols)
+
+
+def initial_permutation(initial_key, model, scorer, cipher_frequencies,
+                        symbols=SYMBOLS):
+    """Starting permutation of a chain.
+
+    initial_key is None or 'identity' for the identity key, 'frequency'
+    for frequency_rank_permutation, 'greedy' for that followed by one
+    greedy_refine pass, or a decryption mapping to start from."""
+    if initial_key is None or initial_key == 'identity':
+        return np.arange(model.size)
+    if isinstance(initial_key, dict):
+        return key_to_permutation(initial_key, symbols)
+    if initial_key not in ('frequency', 'greedy'):
+        raise ValueError(f"Unknown initial key: {initial_key!r}")
+    plain = frequency_rank_permutation(
+        cipher_frequencies, model.unigram_frequencies())
+    if initial_key == 'greedy':
+        greedy_refine(scorer, plain)
+    return plain
+
+
+def constant_schedule(start, end, iterations):
+    """Always the end temperature."""
+    return lambda step, since_improvement: end
+
+
+def linear_schedule(start, end, iterations):
+    """Cools linearly from start to end over iterations."""
+    def temperature(step, since_improvement):
+        return start + (end - start) * min(step / iterations, 1.0)
+    return temperature
+
+
+def geometric_schedule(start, end, iterations):
+    """Cools by a constant factor per step from start to end."""
+    def temperature(step, since_improvement):
+        return start * (end / start) ** min(step / iterations, 1.0)
+    return temperature
+
+
+def logarithmic_schedule(start, end, iterations):
+    """start / (1 + c log(1 + step)), with c chosen to reach end at the
+    last iteration."""
+    c = (start / end - 1) / np.log1p(iterations)
+
+    def temperature(step, since_improvement):
+        return start / (1 + c * np.log1p(step))
+    return temperature
+
+
+class ReheatingSchedule:
+    """Geometric cooling from start to end over cycle steps that starts
+    over from start whenever the best score has not improved for
+    patience steps. cycle defaults to a quarter of the run and patience
+    to a tenth."""
+
+    def __init__(self, start, end, iterations, cycle=None, patience=None):
+        self.start = start
+        self.end = end
+        self.cycle = cycle or max(iterations // 4, 1)
+        self.patience = patience or max(iterations // 10, 1)
+        self.cycle_start = 0
+
+    def __call__(self, step, since_improvement):
+        if (since_improvement >= self.patience
+                and step - self.cycle_start >= self.patience):
+            self.cycle_start = step
+        progress = min((step - self.cycle_start) / self.cycle, 1.0)
+        return self.start * (self.end / self.start) ** progress
+
+
+SCHEDULES = {
+    'constant': constant_schedule,
+    'linear': linear_schedule,
+    'geometric': geometric_schedule,
+    'logarithmic': logarithmic_schedule,
+    'reheat': ReheatingSchedule,
+}
+
+
+def cooling_schedule(schedule, start, end, iterations):
+    """Returns a temperature function of (step, since_improvement), where
+    step counts iterations from 1 and since_improvement is the number of
+    iterations since the best score last improved.
+
+    schedule is a name from SCHEDULES, built for cooling from start to
+    end over iterations, or such a function, which is returned as is."""
+    if callable(schedule):
+        return schedule
+    if schedule not in SCHEDULES:
+        raise ValueError(f"Unknown cooling schedule: {schedule!r}")
+    return SCHEDULES[schedule](start, end, max(iterations, 1))
+
+
+class ConvergenceMonitor:
+    """Early stopping rules for a sampler run.
+
+    plateau stops after that many iterations without a new best log
+    likelihood, target stops once the best log likelihood reaches that
+    value and max_rejections stops after that many proposals in a row
+    were rejected. Rules left as None are not applied."""
+
+    def __init__(self, plateau=None, target=None, max_rejections=None):
+        self.plateau = plateau
+        self.target = target
+        self.max_rejections = max_rejections
+        self.since_best = 0
+        self.rejections = 0
+
+    @classmethod
+    def for_text(cls, entropy, n_bigrams, plateau=None, entropy_ratio=None,
+                 max_rejections=None):
+        """Builds a monitor whose target is reached once the per-bigram
+        log likelihood is within entropy_ratio times the reference
+        entropy, or returns None when no rule is set."""
+        if (plateau is None and entropy_ratio is None
+                and max_rejections is None):
+            return None
+        target = None
+        if entropy_ratio is not None:
+            target = -entropy * entropy_ratio * n_bigrams
+        return cls(plateau, target, max_rejections)
+
+    def update(self, accepted, improved, best_log_likelihood):
+        """Records one iteration and returns the name of the rule that
+        stops the run, or None to continue."""
+        self.since_best = 0 if improved else self.since_best + 1
+        self.rejections = 0 if accepted else self.rejections + 1
+        if self.target is not None and best_log_likelihood >= self.target:
+            return 'entropy'
+        if self.plateau is not None and self.since_best >= self.plateau:
+            return 'plateau'
+        if (self.max_rejections is not None
+                and self.rejections >= self.max_rejections):
+            return 'rejections'
+        return None
+
+
+class TraceRecorder:
+    """Records the current log likelihood of a sampler run.
+
+    mode='list' keeps a Python list, 'array' a preallocated float array,
+    'ring' only the last size values and 'summary' no values at all.
+    With thin=n only every n-th iteration is recorded, counting the
+    starting score as iteration 0."""
+
+    MODES = ('list', 'array', 'ring', 'summary')
+
+    def __init__(self, mode='list', iterations=0, thin=1, size=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown trace mode: {mode!r}")
+        if thin < 1:
+            raise ValueError("thin must be at least 1")
+        if mode == 'ring' and not size:
+            raise ValueError("A ring trace needs a positive size")
+        self.mode = mode
+        self.thin = thin
+        self.size = size
+        self.step = 0
+        self.count = 0
+        self.values = None
+        if mode == 'list':
+            self.values = []
+        elif mode == 'array':
+            self.values = np.empty(iterations // thin + 1)
+        elif mode == 'ring':
+            self.values = np.empty(size)
+
+    def append(self, value):
+        """Records the log likelihood after one more iteration."""
+        if self.step % self.thin == 0:
+            if self.mode == 'list':
+                self.values.append(value)
+            elif self.mode == 'array':
+                self.values[self.count] = value
+            elif self.mode == 'ring':
+                self.values[self.count % self.size] = value
+            self.count += 1
+        self.step += 1
+
+    def result(self, best_log_likelihood, final_log_likelihood, acceptances):
+        """Returns the recorded trace, or a summary dict in summary mode."""
+        if self.mode == 'list':
+            return self.values
+        if self.mode == 'array':
+            return self.values[:self.count]
+        if self.mode == 'ring':
+            start = max(self.count - self.size, 0) % self.size
+            kept = min(self.count, self.size)
+            return np.roll(self.values, -start)[:kept]
+        iterations = self.step - 1
+        return {
+            'best_log_likelihood': best_log_likelihood,
+            'final_log_likelihood': final_log_likelihood,
+            'acceptance_rate': acceptances / iterations if iterations else 0.0,
+            'iterations': iterations,
+        }
+
+
+class SamplerStats:
+    """Timings and counters of one sampler run.
+
+    Scoring time is the time spent computing swap deltas; acceptance
+    time is the rest of the sampling loop. Full rescoring runs do not
+    split the two."""
+
+    def __init__(self):
+        self.model_build_time = 0.0
+        self.sampling_time = 0.0
+        self.scoring_time = 0.0
+        self.proposals = 0
+        self.acceptances = 0
+        self.improvements = 0
+
+    @property
+    def acceptance_time(self):
+        return max(self.sampling_time - self.scoring_time, 0.0)
+
+    @property
+    def iterations_per_sec(self):
+        if not self.sampling_time:
+            return 0.0
+        return self.proposals / self.sampling_time
+
+    def as_dict(self):
+        """All timings, counters and the iterations per second."""
+        return {
+            'model_build_time': self.model_build_time,
+            'sampling_time': self.sampling_time,
+            'scoring_time': self.scoring_time,
+            'acceptance_time': self.acceptance_time,
+            'proposals': self.proposals,
+            'acceptances': self.acceptances,
+            'improvements': self.improvements,
+            'iterations_per_sec': self.iterations_per_sec,
+        }
+
+
+class _TimedScorer:
+    """Wraps a scorer to add the time of every swap_delta to stats."""
+
+    def __init__(self, scorer, stats):
+        self.scorer = scorer
+        self.stats = stats
+
+    def score(self, plain):
+        return self.scorer.score(plain)
+
+    def swap_delta(self, plain, a, b):
+        start = time.perf_counter()
+        delta = self.scorer.swap_delta(plain, a, b)
+        self.stats.scoring_time += time.perf_counter() - start
+        return delta
+
+
+def _timed_scorer(scorer, stats):
+    return scorer if stats is None else _TimedScorer(scorer, stats)
+
+
+def _env_flag(name):
+    return os.environ.get(name, '').lower() not in ('', '0', 'false', 'no')
+
+
+def _sampler_stats(stats):
+    """Returns the SamplerStats to fill, if any, and whether to log
+    them because only the environment asked for them."""
+    if stats is None and _env_flag(INSTRUMENT_ENV):
+        return SamplerStats(), True
+    return stats, False
+
+
+def _finish_stats(stats, info, sampling_time, log_stats):
+    if stats is None:
+        return
+    stats.sampling_time = sampling_time
+    stats.proposals = info['iterations']
+    stats.acceptances = info['acceptances']
+    stats.improvements = info['improvements']
+    info['stats'] = stats.as_dict()
+    if log_stats:
+        logger.info('Sampler stats: %s', info['stats'])
+
+
+@contextmanager
+def _profiling(profile=None):
+    """Enables a cProfile.Profile around a block. Without one, a
+    MCMC_DECRYPTOR_PROFILE path gets a fresh profile's stats."""
+    path = None
+    if profile is None and os.environ.get(PROFILE_ENV):
+        profile = cProfile.Profile()
+        path = os.environ[PROFILE_ENV]
+    if profile is None:
+        yield
+        return
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        if path:
+            profile.dump_stats(path)
+
+
 def metropolis_sampler_with_logs(
-        encrypted_text, reference_text, iterations=100000, p=0.5):
+        encrypted_text, reference_text, iterations=100000, p=0.5,
+        scoring='delta', plateau=None, entropy_ratio=None,
+        max_rejections=None, return_info=False, trace='list', thin=1,
+        trace_size=None, order=2, stats=None, profile=None,
+        checkpoint=None, checkpoint_interval=60.0, resume=False, seed=None,
+        initial_key=None, polish=False):
     """Performs Metropolis sampling to find the best
-      decryption mapping, with logs."""
-    frequency_matrix = build_frequency_matrix(reference_text)
-    alphabet = string.ascii_lowercase
+      decryption mapping, with logs.
+
+    With scoring='delta' each proposal is scored from the ciphertext's
+    bigram count table, so an iteration costs the same for any text
+    length. scoring='full' decrypts and rescores the whole text instead.
+    reference_text may also be a compiled BigramModel or NgramModel;
+    models built from text are reused through cached_model. order=3 or
+    order=4 scores trigrams or quadgrams instead of bigrams.
+
+    The run ends before iterations when a stopping rule fires: plateau
+    iterations without a new best score, a best per-bigram log
+    likelihood within entropy_ratio times the reference model's entropy,
+    or max_rejections rejected proposals in a row. With return_info=True
+    a dict with the iterations used, the stop_reason and the number of
+    acceptances is returned as a third value.
+
+    trace selects how log likelihoods are recorded: 'list' (the default)
+    or 'array' keep every thin-th value, 'ring' keeps the last trace_size
+    of them and 'summary' returns a dict with the best and final scores
+    and the acceptance rate instead of a trace.
+
+    stats, a SamplerStats, collects timings and counters of the run; with
+    the MCMC_DECRYPTOR_INSTRUMENT environment variable set they are
+    collected and logged even when stats is not given. profile, a
+    cProfile.Profile, is enabled around the sampling loop; with
+    MCMC_DECRYPTOR_PROFILE set to a path the loop is profiled to that
+    file. With return_info=True collected stats are added to the info
+    dict under 'stats'.
+
+    checkpoint is a path where the delta-scored chain saves its full
+    state every checkpoint_interval seconds and when it ends. Calling
+    again with the same arguments and resume=True continues from that
+    state and returns exactly what an uninterrupted run would have.
+
+    seed, an int or a numpy.random.Generator, makes the run reproducible
+    on its own; by default it is seeded from the random module. See
+    ProposalRandom.
+
+    initial_key sets the starting state: the identity key by default,
+    'frequency' to match unigram frequency ranks to the reference model,
+    'greedy' to refine that with a greedy swap pass, or a decryption
+    mapping. See initial_permutation.
+
+    polish=True finishes the delta-scored run with steepest_ascent from
+    the best key; the info dict then reports the polish_swaps applied
+    and the polish_gain in log likelihood."""
+    if scoring not in ('delta', 'full'):
+        raise ValueError(f"Unknown scoring mode: {scoring!r}")
+    if checkpoint is not None and scoring == 'full':
+        raise ValueError("Checkpoints require scoring='delta'")
+    if (initial_key is not None or polish) and scoring == 'full':
+        raise ValueError("initial_key and polish require scoring='delta'")
+    stats, log_stats = _sampler_stats(stats)
+    start = time.perf_counter()
+    model = _as_model(reference_text, order)
+    if stats is not None:
+        stats.model_build_time = time.perf_counter() - start
+    monitor = ConvergenceMonitor.for_text(
+        model.entropy(), max(len(encrypted_text) - model.order + 1, 0),
+        plateau, entropy_ratio, max_rejections)
+    recorder = TraceRecorder(trace, iterations, thin, trace_size)
+    rng = ProposalRandom(seed)
+
+    with _profiling(profile):
+        start = time.perf_counter()
+        if scoring == 'full':
+            best_decryption, log_likelihoods, info = _full_scoring_sampler(
+                encrypted_text, model, iterations, p, monitor, recorder, rng)
+        else:
+            scorer = model.scorer(encrypted_text)
+            plain = initial_permutation(
+                initial_key, model, scorer,
+                np.bincount(model.encode(encrypted_text),
+                            minlength=model.size))
+            best_plain, _, log_likelihoods, info = _metropolis_chain(
+                _timed_scorer(scorer, stats), plain, iterations, p, rng,
+                monitor=monitor, recorder=recorder,
+                checkpoint=_checkpointer(
+                    checkpoint, checkpoint_interval, encrypted_text,
+                    model.log_probs, iterations, p, plateau, entropy_ratio,
+                    max_rejections, trace, thin, trace_size, initial_key),
+                resume=resume)
+            if polish:
+                _, info['polish_gain'], info['polish_swaps'] = (
+                    steepest_ascent(scorer, best_plain))
+            best_decryption = permutation_to_key(best_plain)
+    _finish_stats(stats, info, time.perf_counter() - start, log_stats)
+
+    if return_info:
+        return best_decryption, log_likelihoods, info
+    return best_decryption, log_likelihoods
+
+
+def metropolis_sampler_with_counts(
+        counts, reference_text, iterations=100000, p=0.5, plateau=None,
+        entropy_ratio=None, max_rejections=None, return_info=False,
+        trace='list', thin=1, trace_size=None, stats=None, profile=None,
+        checkpoint=None, checkpoint_interval=60.0, resume=False, seed=None,
+        initial_key=None):
+    """metropolis_sampler_with_logs for a ciphertext given only by its
+    bigram count table, such as one from ciphertext_count_table.
+
+    Each key is scored as a permuted dot product of the counts with the
+    model's log probabilities, so the cost of an iteration does not
+    depend on the length of the message. checkpoint, checkpoint_interval,
+    resume, seed and initial_key work as in metropolis_sampler_with_logs.
+    """
+    stats, log_stats = _sampler_stats(stats)
+    start = time.perf_counter()
+    model = _as_model(reference_text)
+    if stats is not None:
+        stats.model_build_time = time.perf_counter() - start
+    counts = np.asarray(counts, dtype=np.float64)
+    monitor = ConvergenceMonitor.for_text(
+        model.entropy(), counts.sum(), plateau, entropy_ratio,
+        max_rejections)
+    recorder = TraceRecorder(trace, iterations, thin, trace_size)
+    with _profiling(profile):
+        start = time.perf_counter()
+        scorer = BigramScorer(model.log_probs, counts)
+        plain = initial_permutation(
+            initial_key, model, scorer, counts.sum(axis=1))
+        best_plain, _, log_likelihoods, info = _metropolis_chain(
+            _timed_scorer(scorer, stats), plain, iterations, p,
+            ProposalRandom(seed), monitor=monitor,
+            recorder=recorder,
+            checkpoint=_checkpointer(
+                checkpoint, checkpoint_interval, counts, model.log_probs,
+                iterations, p, plateau, entropy_ratio, max_rejections,
+                trace, thin, trace_size, initial_key),
+            resume=resume)
+    _finish_stats(stats, info, time.perf_counter() - start, log_stats)
+    best_decryption = permutation_to_key(best_plain)
+    if return_info:
+        return best_decryption, log_likelihoods, info
+    return best_decryption, log_likelihoods
+
+
+def decrypt_stream(source, reference_text, destination,
+                   chunk_size=CORPUS_CHUNK_SIZE, **sampler_options):
+    """Decrypts a ciphertext file (or stdin, '-') of any size.
+
+    The ciphertext is read once to build its bigram count table, the
+    key is found with metropolis_sampler_with_counts and only that key
+    is applied in a second streaming pass that writes to destination
+    (a path, a binary file object or stdout, '-'). stdin and other
+    unseekable streams are spooled to a temporary file for the second
+    pass. Returns what metropolis_sampler_with_counts returns."""
+    with ExitStack() as stack:
+        stream = stack.enter_context(_open_binary(source))
+        if not stream.seekable():
+            spool = stack.enter_context(tempfile.TemporaryFile())
+            shutil.copyfileobj(stream, spool, chunk_size)
+            spool.seek(0)
+            stream = spool
+        start = stream.tell()
+        counts = ciphertext_count_table(stream, chunk_size)
+        result = metropolis_sampler_with_counts(
+            counts, reference_text, **sampler_options)
+        stream.seek(start)
+        decrypt_file(result[0], stream, destination, chunk_size)
+    return result
+
+
+class Checkpointer:
+    """Saves the state of a sampler run to path, at most once every
+    interval seconds, and loads it back to resume the run.
 
+    fingerprint identifies the ciphertext, model and settings of the
+    run; loading a checkpoint written for a different run is an error.
+    The clock is only read every CHECK_EVERY iterations, so checkpointing
+    does not slow the sampling loop down measurably."""
+
+    CHECK_EVERY = 1024
+
+    def __init__(self, path, interval=60.0, fingerprint=None):
+        self.path = os.fspath(path)
+        self.interval = interval
+        self.fingerprint = fingerprint
+        self._last_save = time.monotonic()
+
+    def due(self):
+        """Whether interval seconds have passed since the last save."""
+        return time.monotonic() - self._last_save >= self.interval
+
+    def save(self, state):
+        """Atomically replaces the checkpoint file with state."""
+        state = dict(state, fingerprint=self.fingerprint)
+        _atomic_save(self.path, lambda file: pickle.dump(
+            state, file, protocol=pickle.HIGHEST_PROTOCOL))
+        self._last_save = time.monotonic()
+
+    def load(self):
+        """Returns the saved state, or None when there is no checkpoint."""
+        try:
+            with open(self.path, 'rb') as file:
+                state = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        if state.pop('fingerprint') != self.fingerprint:
+            raise ValueError(
+                f"Checkpoint {self.path} belongs to a different run")
+        return state
+
+
+def _fingerprint(*parts):
+    """Hash of the arrays, strings and settings that define a run."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, str):
+            digest.update(part.encode('utf-8', 'surrogatepass'))
+        else:
+            digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _checkpointer(checkpoint, checkpoint_interval, *fingerprint_parts):
+    if checkpoint is None:
+        return None
+    return Checkpointer(checkpoint, checkpoint_interval,
+                        _fingerprint(*fingerprint_parts))
+
+
+def _metropolis_chain(scorer, plain, iterations, p, rng=None,
+                      monitor=None, recorder=None, checkpoint=None,
+                      resume=False, log_likelihood=None, best_plain=None,
+                      best_log_likelihood=None):
+    """Runs one delta-scored Metropolis chain from the permutation plain,
+    which is modified in place. scorer is a BigramScorer or NgramScorer
+    for the ciphertext, rng a ProposalRandom (a seeded one by default),
+    monitor an optional ConvergenceMonitor and recorder a TraceRecorder,
+    a full list by default.
+
+    checkpoint, a Checkpointer, saves the permutations, scores, counters,
+    rng state, monitor and recorder periodically and when the run ends.
+    With resume=True the run continues from its saved state, if any,
+    exactly as if it had never stopped.
+
+    log_likelihood is the score of plain, computed by default, and
+    best_plain with best_log_likelihood the best key found so far, plain
+    itself by default; passing the values an earlier run ended with
+    continues that run exactly.
+
+    Returns the best permutation, its log likelihood, the recorded trace
+    and a dict with the iterations used, the stop_reason and the numbers
+    of acceptances and of improvements of the best score."""
+    if rng is None:
+        rng = ProposalRandom()
+    state = checkpoint.load() if checkpoint is not None and resume else None
+    if state is None:
+        current_log_likelihood = (scorer.score(plain) if log_likelihood is None
+                                  else log_likelihood)
+        if best_plain is None:
+            best_plain = plain.copy()
+            best_log_likelihood = current_log_likelihood
+        else:
+            best_plain = best_plain.copy()
+        stop_reason = 'iterations'
+        acceptances = improvements = 0
+        done = 0
+        if recorder is None:
+            recorder = TraceRecorder('list')
+        recorder.append(current_log_likelihood)
+    else:
+        plain[:] = state['plain']
+        best_plain = state['best_plain']
+        current_log_likelihood = state['current_log_likelihood']
+        best_log_likelihood = state['best_log_likelihood']
+        stop_reason = state['stop_reason']
+        acceptances = state['acceptances']
+        improvements = state['improvements']
+        done = state['done']
+        monitor = state['monitor']
+        recorder = state['recorder']
+        rng.setstate(state['rng_state'])
+
+    def save():
+        checkpoint.save({
+            'plain': plain, 'best_plain': best_plain,
+            'current_log_likelihood': current_log_likelihood,
+            'best_log_likelihood': best_log_likelihood,
+            'stop_reason': stop_reason, 'acceptances': acceptances,
+            'improvements': improvements, 'done': done,
+            'monitor': monitor, 'recorder': recorder,
+            'rng_state': rng.getstate()})
+
+    if stop_reason != 'iterations':
+        iterations = done
+    for done in range(done + 1, iterations + 1):
+        a, b, log_threshold = rng.draw()
+        delta = scorer.swap_delta(plain, a, b)
+
+        accepted = improved = False
+        if delta * p > log_threshold:
+            accepted = True
+            acceptances += 1
+            current_log_likelihood += delta
+            if current_log_likelihood > best_log_likelihood:
+                improved = True
+                improvements += 1
+                best_plain[:] = plain
+                best_log_likelihood = current_log_likelihood
+        else:
+            plain[a], plain[b] = plain[b], plain[a]
+
+        recorder.append(current_log_likelihood)
+
+        if monitor is not None:
+            reason = monitor.update(accepted, improved, best_log_likelihood)
+            if reason is not None:
+                stop_reason = reason
+                break
+
+        if (checkpoint is not None
+                and done % Checkpointer.CHECK_EVERY == 0
+                and checkpoint.due()):
+            save()
+
+    if checkpoint is not None:
+        save()
+
+    info = {'iterations': recorder.step - 1, 'stop_reason': stop_reason,
+            'acceptances': acceptances, 'improvements': improvements}
+    log_likelihoods = recorder.result(
+        best_log_likelihood, current_log_likelihood, acceptances)
+    return best_plain, best_log_likelihood, log_likelihoods, info
+
+
+def _full_scoring_sampler(encrypted_text, model, iterations, p,
+                          monitor=None, recorder=None, rng=None):
+    """Reference sampler that decrypts and rescores the whole text for
+    every proposal; takes the same ProposalRandom draws as the
+    delta-scoring loop."""
+    if rng is None:
+        rng = ProposalRandom()
+    alphabet = string.ascii_lowercase
     current_decryption = {char: char for char in alphabet}
     current_log_likelihood = compute_log_likelihood(
-        current_decryption, encrypted_text, frequency_matrix)
+        current_decryption, encrypted_text, model)
     best_decryption = current_decryption
     best_log_likelihood = current_log_likelihood
+    stop_reason = 'iterations'
+    acceptances = improvements = 0
 
-    log_likelihoods = [current_log_likelihood]
+    if recorder is None:
+        recorder = TraceRecorder('list')
+    recorder.append(current_log_likelihood)
 
     for _ in range(iterations):
-        proposed_decryption = random_swap(current_decryption)
+        a, b, log_threshold = rng.draw()
+        proposed_decryption = current_decryption.copy()
+        proposed_decryption[alphabet[a]], proposed_decryption[alphabet[b]] = (
+            current_decryption[alphabet[b]], current_decryption[alphabet[a]])
         proposed_log_likelihood = compute_log_likelihood(
-            proposed_decryption, encrypted_text, frequency_matrix
-            )
+            proposed_decryption, encrypted_text, model)
 
-        acceptance_prob = min(1, np.exp(
-            (proposed_log_likelihood - current_log_likelihood) * p))
-        if random.random() < acceptance_prob:
+        accepted = improved = False
+        if ((proposed_log_likelihood - current_log_likelihood) * p
+                > log_threshold):
+            accepted = True
+            acceptances += 1
             current_decryption = proposed_decryption
             current_log_likelihood = proposed_log_likelihood
 
         if current_log_likelihood > best_log_likelihood:
+            improved = True
+            improvements += 1
             best_decryption = current_decryption
             best_log_likelihood = current_log_likelihood
 
-        log_likelihoods.append(current_log_likelihood)
+        recorder.append(current_log_likelihood)
 
-    return best_decryption, log_likelihoods
+        if monitor is not None:
+            reason = monitor.update(accepted, improved, best_log_likelihood)
+            if reason is not None:
+                stop_reason = reason
+                break
+
+    info = {'iterations': recorder.step - 1, 'stop_reason': stop_reason,
+            'acceptances': acceptances, 'improvements': improvements}
+    log_likelihoods = recorder.result(
+        best_log_likelihood, current_log_likelihood, acceptances)
+    return best_decryption, log_likelihoods, info
+
+
+def _lockstep_step(counts, log_probs, plain, current, p, rng):
+    """Proposes and accepts or reverts one swap in every row of plain,
+    updating plain and the current log likelihoods in place. p may be a
+    scalar or one value per chain."""
+    chains = len(plain)
+    letters = len(string.ascii_lowercase)
+    a = rng.integers(letters, size=chains)
+    b = rng.integers(letters - 1, size=chains)
+    b += b >= a
+    delta = swap_deltas(counts, log_probs, plain, a, b)
+
+    accepted = delta * p > -rng.standard_exponential(chains)
+    rejected = np.flatnonzero(~accepted)
+    _swap_rows(plain, a[rejected], b[rejected], rejected)
+    current[accepted] += delta[accepted]
+
+
+def metropolis_sampler_multichain(
+        encrypted_text, reference_text, chains=64, iterations=10000, p=0.5,
+        seed=None):
+    """Runs independent Metropolis chains in lockstep, scoring the
+    proposals of every chain in one NumPy operation per step.
+
+    Returns the best decryption mapping across all chains and an
+    (iterations + 1) x chains array of log likelihood traces."""
+    model = _as_model(reference_text)
+    rng = np.random.default_rng(seed)
+    counts = model.count_table(encrypted_text).astype(np.float64)
+    log_probs = model.log_probs
+
+    plain = np.tile(np.arange(model.size), (chains, 1))
+    best_plain = plain.copy()
+    current = np.full(chains, (counts * log_probs).sum())
+    best = current.copy()
+    log_likelihoods = np.empty((iterations + 1, chains))
+    log_likelihoods[0] = current
+
+    for step in range(1, iterations + 1):
+        _lockstep_step(counts, log_probs, plain, current, p, rng)
+
+        improved = current > best
+        best_plain[improved] = plain[improved]
+        best[improved] = current[improved]
+        log_likelihoods[step] = current
+
+    return permutation_to_key(best_plain[best.argmax()]), log_likelihoods
+
+
+def metropolis_sampler_parallel_tempering(
+        encrypted_text, reference_text, p_values=(0.05, 0.1, 0.2, 0.35, 0.5,
+                                                  0.65, 0.8, 1.0),
+        iterations=10000, exchange_interval=10, seed=None):
+    """Replica-exchange Metropolis sampling over a ladder of p values.
+
+    One replica runs at each p (the factor applied to log likelihood
+    differences, so small p is hot). Every exchange_interval steps,
+    neighbouring replicas on the ladder swap keys with the replica
+    exchange acceptance probability, alternating between even and odd
+    neighbour pairs.
+
+    Returns the best decryption mapping over all replicas and an
+    (iterations + 1) x len(p_values) array of traces, one column per
+    p value."""
+    model = _as_model(reference_text)
+    rng = np.random.default_rng(seed)
+    counts = model.count_table(encrypted_text).astype(np.float64)
+    log_probs = model.log_probs
+    p_values = np.asarray(p_values, dtype=np.float64)
+    replicas = len(p_values)
+
+    plain = np.tile(np.arange(model.size), (replicas, 1))
+    current = np.full(replicas, (counts * log_probs).sum())
+    best_plain = plain[0].copy()
+    best = current[0]
+    log_likelihoods = np.empty((iterations + 1, replicas))
+    log_likelihoods[0] = current
+
+    for step in range(1, iterations + 1):
+        _lockstep_step(counts, log_probs, plain, current, p_values, rng)
+
+        if step % exchange_interval == 0:
+            lower = np.arange((step // exchange_interval) % 2, replicas - 1, 2)
+            upper = lower + 1
+            log_ratio = ((p_values[lower] - p_values[upper])
+                         * (current[upper] - current[lower]))
+            with np.errstate(divide='ignore'):
+                swapped = np.log(rng.random(len(lower))) < log_ratio
+            lower, upper = lower[swapped], upper[swapped]
+            plain[lower], plain[upper] = plain[upper], plain[lower]
+            current[lower], current[upper] = current[upper], current[lower]
+
+        leader = current.argmax()
+        if current[leader] > best:
+            best_plain[:] = plain[leader]
+            best = current[leader]
+        log_likelihoods[step] = current
+
+    return permutation_to_key(best_plain), log_likelihoods
+
+
+_restart_worker_state = {}
+
+
+def _share_arrays(arrays):
+    """Copies arrays into one shared memory block; returns the block and
+    the (shape, dtype, offset) layout needed to map them again."""
+    block = shared_memory.SharedMemory(
+        create=True, size=max(sum(array.nbytes for array in arrays), 1))
+    layout = []
+    offset = 0
+    for array in arrays:
+        view = np.ndarray(
+            array.shape, array.dtype, buffer=block.buf, offset=offset)
+        view[...] = array
+        layout.append((array.shape, array.dtype.str, offset))
+        offset += array.nbytes
+    return block, layout
+
+
+def _attach_arrays(name, layout):
+    """Maps the arrays of a _share_arrays block without copying them."""
+    block = shared_memory.SharedMemory(name=name)
+    arrays = [np.ndarray(shape, np.dtype(dtype), buffer=block.buf,
+                         offset=offset)
+              for shape, dtype, offset in layout]
+    return block, arrays
+
+
+def _init_restart_worker(name, layout):
+    block, (log_probs, codes) = _attach_arrays(name, layout)
+    _restart_worker_state.update(
+        block=block, log_probs=log_probs,
+        counts=bigram_count_table(codes, len(log_probs)).astype(np.float64))
+
+
+def _restart_worker(task):
+    seed, iterations, p = task
+    log_probs = _restart_worker_state['log_probs']
+    counts = _restart_worker_state['counts']
+    rng = ProposalRandom(seed)
+    letters = rng.permutation()
+    plain = np.arange(len(log_probs))
+    plain[:len(letters)] = letters
+    best_plain, best_log_likelihood, _, _ = _metropolis_chain(
+        BigramScorer(log_probs, counts), plain, iterations, p, rng,
+        recorder=TraceRecorder('summary'))
+    return best_plain, best_log_likelihood
+
+
+def metropolis_sampler_parallel_restarts(
+        encrypted_text, reference_text, restarts=8, iterations=100000,
+        p=0.5, processes=None, agreement=None, seed=None):
+    """Runs independent restarts of the Metropolis sampler from random
+    keys on a process pool.
+
+    The compiled model and the encoded ciphertext are placed in shared
+    memory once and mapped by every worker. Once agreement restarts
+    have found the same best key the remaining restarts are cancelled.
+
+    Returns the best decryption mapping and the best log likelihood of
+    each restart that finished, in completion order."""
+    model = _as_model(reference_text)
+    seeds = random.Random(seed)
+    tasks = [(seeds.getrandbits(64), iterations, p) for _ in range(restarts)]
+    codes = model.encode(encrypted_text)
+    used = np.bincount(codes, minlength=model.size) > 0
+    block, layout = _share_arrays([model.log_probs, codes])
+
+    best_plain = np.arange(model.size)
+    best_log_likelihood = -np.inf
+    best_log_likelihoods = []
+    votes = Counter()
+    pool = multiprocessing.Pool(
+        processes, initializer=_init_restart_worker,
+        initargs=(block.name, layout))
+    try:
+        for plain, log_likelihood in pool.imap_unordered(
+                _restart_worker, tasks):
+            best_log_likelihoods.append(log_likelihood)
+            if log_likelihood > best_log_likelihood:
+                best_plain = plain
+                best_log_likelihood = log_likelihood
+            # Letters absent from the ciphertext do not affect the
+            # score, so only the used symbols have to agree.
+            key = plain[used].tobytes()
+            votes[key] += 1
+            if agreement and votes[key] >= agreement:
+                break
+    finally:
+        # Stop the remaining restarts and wait for every worker to exit
+        # before the shared block they map is released.
+        pool.terminate()
+        pool.join()
+        block.close()
+        block.unlink()
+
+    return permutation_to_key(best_plain), best_log_likelihoods
+
+
+_decryptor_worker_state = {}
+
+
+def _init_decryptor_worker(name, layout, symbols, options):
+    block, (log_probs,) = _attach_arrays(name, layout)
+    model_class = BigramModel if log_probs.ndim == 2 else NgramModel
+    _decryptor_worker_state.update(
+        block=block, model=model_class(log_probs, symbols), options=options)
+
+
+def _decryptor_worker(task):
+    index, ciphertext, seed = task
+    decryption = _decrypt_message(
+        _decryptor_worker_state['model'], ciphertext, seed,
+        **_decryptor_worker_state['options'])
+    return index, decryption
+
+
+def _decrypt_message(model, ciphertext, seed, iterations, p, plateau,
+                     entropy_ratio, max_rejections):
+    """Runs one delta-scored chain for a message and returns its best
+    decryption mapping."""
+    decryption, _, _ = _run_message_chain(
+        model, ciphertext, seed, iterations, p, plateau, entropy_ratio,
+        max_rejections)
+    return decryption
+
+
+def _run_message_chain(model, ciphertext, seed, iterations, p, plateau,
+                       entropy_ratio, max_rejections, segment=None,
+                       report=None, cancelled=None, deadline=None):
+    """Runs one delta-scored chain for a message in segments of segment
+    iterations, which continue each other exactly.
+
+    After every segment that improved the best key, report(event) is
+    called with a progress event dict, and the chain stops early with
+    stop_reason 'cancelled' once cancelled() is true or 'deadline' once
+    time.time() has reached deadline. Returns the best decryption
+    mapping, its log likelihood and a dict with the iterations used and
+    the stop_reason."""
+    monitor = ConvergenceMonitor.for_text(
+        model.entropy(), max(len(ciphertext) - model.order + 1, 0),
+        plateau, entropy_ratio, max_rejections)
+    scorer = model.scorer(ciphertext)
+    rng = ProposalRandom(seed)
+    plain = np.arange(model.size)
+    best_plain = plain.copy()
+    current_log_likelihood = best_log_likelihood = scorer.score(plain)
+    stop_reason = 'iterations'
+    done = 0
+    while done < iterations:
+        segment_plain, segment_log_likelihood, summary, info = (
+            _metropolis_chain(
+                scorer, plain, min(segment or iterations, iterations - done),
+                p, rng, monitor=monitor, recorder=TraceRecorder('summary'),
+                log_likelihood=current_log_likelihood, best_plain=best_plain,
+                best_log_likelihood=best_log_likelihood))
+        current_log_likelihood = summary['final_log_likelihood']
+        done += info['iterations']
+        if segment_log_likelihood > best_log_likelihood:
+            best_plain = segment_plain
+            best_log_likelihood = segment_log_likelihood
+            if report is not None:
+                report({'event': 'progress', 'iterations': done,
+                        'log_likelihood': float(best_log_likelihood),
+                        'key': permutation_to_key(best_plain,
+                                                  model.symbols)})
+        if info['stop_reason'] != 'iterations':
+            stop_reason = info['stop_reason']
+            break
+        if cancelled is not None and cancelled():
+            stop_reason = 'cancelled'
+            break
+        if deadline is not None and time.time() >= deadline:
+            stop_reason = 'deadline'
+            break
+    return (permutation_to_key(best_plain, model.symbols),
+            float(best_log_likelihood),
+            {'iterations': done, 'stop_reason': stop_reason})
+
+
+class Decryptor:
+    """Decrypts many messages with one compiled language model.
+
+    reference is a reference text, which is compiled once through
+    cached_model, or an already compiled BigramModel or NgramModel. The
+    remaining arguments are passed to the Metropolis chain run for each
+    message. Seeding makes the results reproducible message by message.
+
+    decrypt_many runs on a process pool that is started on first use and
+    kept until close(); the model table is placed in shared memory once
+    and mapped by every worker. Use the Decryptor as a context manager
+    to release both."""
+
+    def __init__(self, reference, order=2, iterations=10000, p=0.5,
+                 plateau=None, entropy_ratio=None, max_rejections=None,
+                 processes=None, seed=None):
+        self.model = _as_model(reference, order)
+        self.options = {
+            'iterations': iterations, 'p': p, 'plateau': plateau,
+            'entropy_ratio': entropy_ratio,
+            'max_rejections': max_rejections}
+        self.processes = processes
+        self._seeds = random.Random(seed)
+        self._pool = None
+        self._block = None
+
+    def decrypt(self, ciphertext):
+        """Returns the best decryption mapping found for one message."""
+        return _decrypt_message(
+            self.model, ciphertext, self._seeds.getrandbits(64),
+            **self.options)
+
+    def decrypt_many(self, ciphertexts, chunksize=1):
+        """Decrypts every message of an iterable on the process pool.
+
+        Messages are scheduled longest first, so the slowest ones do not
+        end up last, and (index, decryption) pairs are yielded as they
+        complete, where index is the message's position in ciphertexts."""
+        tasks = [(index, ciphertext, self._seeds.getrandbits(64))
+                 for index, ciphertext in enumerate(ciphertexts)]
+        tasks.sort(key=lambda task: len(task[1]), reverse=True)
+        yield from self._worker_pool().imap_unordered(
+            _decryptor_worker, tasks, chunksize)
+
+    def _worker_pool(self):
+        if self._pool is None:
+            self._block, layout = _share_arrays([self.model.log_probs])
+            self._pool = multiprocessing.Pool(
+                self.processes, initializer=_init_decryptor_worker,
+                initargs=(self._block.name, layout, self.model.symbols,
+                          self.options))
+        return self._pool
+
+    def close(self):
+        """Stops the worker pool and frees the shared model table."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._block is not None:
+            self._block.close()
+            self._block.unlink()
+            self._block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 def generate_encryption_key():
@@ -97,4 +2200,4 @@ def generate_encryption_key():
 
 def encrypt_text(plaintext, encryption_key):
     """Encrypts the plaintext using the given encryption key."""
-    return ''.join(encryption_key.get(char, char) for char in plaintext)
+    return plaintext.translate(compile_key(encryption_key))
@@ -2,7 +2,24 @@ import random
 import string
 import numpy as np
 import matplotlib.pyplot as plt
-from collections import Counter
+from functools import lru_cache
+from mcmc_decryptor import (
+    MODEL_CACHE,
+    SYMBOLS,
+    BigramModel,
+    BigramScorer,
+    ConvergenceMonitor,
+    ProposalRandom,
+    bigram_count_table,
+    cooling_schedule,
+    corpus_hash,
+    encode_text,
+    initial_permutation,
+    permutation_to_key,
+    score_permutation,
+    steepest_ascent,
+    swap_delta,
+)
 
 
 def preprocess_text(text):
@@ -10,10 +27,24 @@ def preprocess_text(text):
     Preprocess the text by converting to lowercase and
       removing non-alphabetic characters
     except spaces. Spaces are preserved to help with decryption.
+
+    Each distinct character is classified once and the text is rewritten
+    with a single str.translate call.
     """
-    return ''.join(
-        [char.lower() if char.isalpha() or char.isspace()
-         else '' for char in text])
+    table = {
+        ord(char): char.lower() if char.isalpha() or char.isspace() else None
+        for char in set(text)}
+    return text.translate(table)
+
+
+def read_text(file_name):
+    """
+    Read a UTF-8 text file, ignoring undecodable bytes and translating
+    newlines like open() in text mode.
+    """
+    with open(file_name, 'rb') as file:
+        text = str(file.read(), 'utf-8', 'ignore')
+    return text.replace('\r\n', '\n').replace('\r', '\n')
 
 
 def generate_random_key():
@@ -32,8 +63,13 @@ def apply_decryption(decryption_key, ciphertext):
     Decrypt the ciphertext using the provided decryption key,
       keeping spaces intact.
     """
-    inverse_key = {v: k for k, v in decryption_key.items()}
-    return ''.join([inverse_key.get(char, char) for char in ciphertext])
+    return ciphertext.translate(_inverse_table(tuple(decryption_key.items())))
+
+
+@lru_cache(maxsize=64)
+def _inverse_table(key_items):
+    """Translate table of an inverted key, compiled once per key."""
+    return str.maketrans({v: k for k, v in key_items})
 
 
 def calculate_bigram_likelihood(text, bigram_probs):
@@ -47,112 +83,252 @@ def calculate_bigram_likelihood(text, bigram_probs):
     return likelihood
 
 
+def compile_bigram_probs(bigram_probs, symbols):
+    """
+    Compile a bigram probability dict into a BigramModel over the given
+    symbols, scoring unseen bigrams at 1e-6 like calculate_bigram_likelihood.
+    """
+    log_probs = np.full((len(symbols) + 1,) * 2, np.log(1e-6))
+    for i, first in enumerate(symbols):
+        for j, second in enumerate(symbols):
+            probability = bigram_probs.get(first + second)
+            if probability is not None:
+                log_probs[i, j] = np.log(probability)
+    return BigramModel(log_probs, symbols)
+
+
 def metropolis_sampler_with_bigram(
-        ciphertext, bigram_probs, iterations=10000, temperature=0.85):
+        ciphertext, bigram_probs, iterations=10000, temperature=0.85,
+        plateau=None, entropy_ratio=None, max_rejections=None,
+        return_info=False, seed=None, initial_key=None, polish=False,
+        schedule='constant', start_temperature=None):
     """
     Perform Metropolis sampling to decrypt the ciphertext by
       optimizing a substitution key
     based on bigram likelihood.
-    """
-    alphabet = list(string.ascii_lowercase)
-    current_key = generate_random_key()
-    best_key = current_key.copy()
 
-    current_decryption = apply_decryption(current_key, ciphertext)
-    current_likelihood = calculate_bigram_likelihood(
-        current_decryption, bigram_probs)
+    The key is held as an integer permutation of the ciphertext's symbol
+    codes, swapped in place and reverted on rejection; only the returned
+    key is converted back to a dict.
+
+    plateau, entropy_ratio and max_rejections end the run early as in
+    mcmc_decryptor.metropolis_sampler_with_logs, with the entropy taken
+    from bigram_probs. return_info=True adds a dict with the iterations
+    used and the stop_reason as a third return value.
+
+    seed, an int or a numpy.random.Generator, makes the run reproducible;
+    proposals and acceptance thresholds are drawn in blocks by a
+    mcmc_decryptor.ProposalRandom.
+
+    The chain starts from a random key unless initial_key is 'identity',
+    'frequency' (unigram frequency ranks matched to bigram_probs),
+    'greedy' (that plus a greedy swap pass) or an encryption key dict as
+    returned by this function; a key that is not one-to-one on the
+    letters raises ValueError.
+
+    polish=True finishes with mcmc_decryptor.steepest_ascent from the
+    best key, and return_info then also reports the polish_gain in log
+    likelihood and the polish_swaps applied.
+
+    schedule varies the temperature over the run: 'constant' keeps it at
+    temperature, while 'linear', 'geometric', 'logarithmic' and 'reheat'
+    cool from start_temperature (by default ten times temperature) down
+    to temperature. A callable taking the iteration number and the
+    iterations since the best score last improved may be given instead;
+    see mcmc_decryptor.cooling_schedule. With return_info=True the
+    temperature of every iteration is reported as info['temperatures'].
+    """
+    alphabet = string.ascii_lowercase
+    symbols = alphabet + ''.join(sorted(set(ciphertext) - set(alphabet)))
+    model = compile_bigram_probs(bigram_probs, symbols)
+    codes = encode_text(ciphertext, symbols)
+    counts = bigram_count_table(codes, model.size).astype(np.float64)
+    entropy = -sum(
+        probability * np.log(probability)
+        for probability in bigram_probs.values())
+    monitor = ConvergenceMonitor.for_text(
+        entropy, max(len(ciphertext) - 1, 0), plateau, entropy_ratio,
+        max_rejections)
+
+    if start_temperature is None:
+        start_temperature = 10 * temperature
+    temperature_at = cooling_schedule(
+        schedule, start_temperature, temperature, iterations)
+    temperatures = [] if return_info else None
+    since_improvement = 0
+
+    rng = ProposalRandom(seed)
+    if initial_key is None:
+        plain = np.arange(model.size)
+        plain[:len(alphabet)] = rng.permutation()
+    else:
+        if isinstance(initial_key, dict):
+            if len(set(initial_key.values())) < len(initial_key):
+                raise ValueError(
+                    "initial_key maps two letters to the same letter")
+            initial_key = {v: k for k, v in initial_key.items()}
+        plain = initial_permutation(
+            initial_key, model, BigramScorer(model.log_probs, counts),
+            np.bincount(codes, minlength=model.size), symbols)
+    best_plain = plain.copy()
+
+    current_likelihood = score_permutation(counts, model.log_probs, plain)
     best_likelihood = current_likelihood
+    stop_reason = 'iterations'
 
     log_likelihoods = [current_likelihood]
 
-    for _ in range(iterations):
-        # Propose a new key by swapping two letters
-        i, j = random.sample(range(26), 2)
-        new_key = current_key.copy()
-        new_key[alphabet[i]], new_key[alphabet[j]] = current_key[alphabet[j]], current_key[alphabet[i]]
-
-        # Calculate the likelihood of the new key
-        new_decryption = apply_decryption(new_key, ciphertext)
-        new_likelihood = calculate_bigram_likelihood(
-            new_decryption, bigram_probs)
+    for step in range(1, iterations + 1):
+        # Propose a new key by swapping two letters in place
+        i, j, log_threshold = rng.draw()
+        delta = swap_delta(counts, model.log_probs, plain, i, j)
 
         # Accept or reject the new key based on likelihood and temperature
-        if (new_likelihood > current_likelihood or
-                random.random() < np.exp(
-                    (new_likelihood - current_likelihood) / temperature)):
-            current_key = new_key
-            current_likelihood = new_likelihood
+        current_temperature = temperature_at(step, since_improvement)
+        accepted = improved = False
+        if delta / current_temperature > log_threshold:
+            accepted = True
+            current_likelihood += delta
 
             if current_likelihood > best_likelihood:
-                best_key = current_key.copy()
+                improved = True
+                best_plain[:] = plain
                 best_likelihood = current_likelihood
+        else:
+            plain[i], plain[j] = plain[j], plain[i]
+        since_improvement = 0 if improved else since_improvement + 1
 
         log_likelihoods.append(current_likelihood)
-
+        if temperatures is not None:
+            temperatures.append(current_temperature)
+
+        if monitor is not None:
+            reason = monitor.update(accepted, improved, best_likelihood)
+            if reason is not None:
+                stop_reason = reason
+                break
+
+    info = {'iterations': len(log_likelihoods) - 1,
+            'stop_reason': stop_reason}
+    if temperatures is not None:
+        info['temperatures'] = temperatures
+    if polish:
+        _, info['polish_gain'], info['polish_swaps'] = steepest_ascent(
+            BigramScorer(model.log_probs, counts), best_plain)
+
+    best_decryption = permutation_to_key(best_plain, symbols)
+    best_key = {v: k for k, v in best_decryption.items()}
+    if return_info:
+        return best_key, log_likelihoods, info
     return best_key, log_likelihoods
 
 
-def train_bigram_model(reference_texts):
+def train_bigram_model(reference_texts, cache_dir=None):
     """
     Train a bigram probability model from reference texts.
+
+    Models are cached by a hash of the texts, in process and, when
+    cache_dir or MCMC_DECRYPTOR_CACHE is set, as .npz files on disk.
+    The returned dict is shared with the cache and must not be modified.
     """
-    bigram_counts = Counter()
-    total_bigrams = 0
+    key = corpus_hash(*reference_texts, symbols='')
+    return MODEL_CACHE.get_or_build(
+        ('bigram_probs', key),
+        lambda: _count_bigram_probs(reference_texts),
+        filename=f'bigram-probs-{key}.npz',
+        load=_load_bigram_probs,
+        save=_save_bigram_probs,
+        cache_dir=cache_dir)
+
 
+def store_bigram_model(store, books=None):
+    """
+    Bigram probability dict of the named books (or mixture weights) of
+    an mcmc_decryptor.CountStore, summed from their stored counts
+    instead of retraining on the texts. Only bigrams of letters and
+    spaces are included.
+    """
+    counts = store.counts(books)[:len(SYMBOLS), :len(SYMBOLS)]
+    total = counts.sum()
+    firsts, seconds = np.nonzero(counts)
+    return {
+        SYMBOLS[first] + SYMBOLS[second]: count / total
+        for first, second, count in zip(
+            firsts.tolist(), seconds.tolist(),
+            counts[firsts, seconds].tolist())}
+
+
+def _count_bigram_probs(reference_texts):
+    pair_codes = []
     for text in reference_texts:
-        for i in range(len(text) - 1):
-            bigram = text[i:i + 2]
-            bigram_counts[bigram] += 1
-            total_bigrams += 1
+        points = np.frombuffer(
+            text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        pair_codes.append((points[:-1] << np.uint64(32)) | points[1:])
+    pairs, counts = np.unique(
+        np.concatenate(pair_codes or [np.empty(0, np.uint64)]),
+        return_counts=True)
+    total_bigrams = int(counts.sum())
 
     bigram_probs = {
-        bigram: count / total_bigrams for bigram,
-        count in bigram_counts.items()}
+        chr(pair >> 32) + chr(pair & 0xFFFFFFFF): count / total_bigrams
+        for pair, count in zip(pairs.tolist(), counts.tolist())}
     return bigram_probs
 
 
-with open('some_text_encrypted.txt', 'r') as file:
-    ciphertext = preprocess_text(file.read())
+def _save_bigram_probs(file, bigram_probs):
+    np.savez(file, bigrams=np.array(list(bigram_probs), dtype='U2'),
+             probabilities=np.fromiter(bigram_probs.values(), np.float64))
 
-# Load and preprocess Gutenberg reference texts
-reference_texts = []
-file_names = [
-    'pg74880.txt',
-    'pg74881.txt',
-    'pg74882.txt',
-    'pg74883.txt',
-    'pg74884.txt'
-]
 
-for file_name in file_names:
-    with open(file_name, 'r', errors='ignore') as file:
-        reference_texts.append(preprocess_text(file.read()))
+def _load_bigram_probs(path):
+    with np.load(path) as data:
+        return dict(zip(data['bigrams'].tolist(),
+                        data['probabilities'].tolist()))
 
 
-bigram_probs = train_bigram_model(reference_texts)
+def main():
+    ciphertext = preprocess_text(read_text('some_text_encrypted.txt'))
 
+    # Load and preprocess Gutenberg reference texts
+    reference_texts = []
+    file_names = [
+        'pg74880.txt',
+        'pg74881.txt',
+        'pg74882.txt',
+        'pg74883.txt',
+        'pg74884.txt'
+    ]
 
-iterations = 10000
-temperature = 0.85
+    for file_name in file_names:
+        reference_texts.append(preprocess_text(read_text(file_name)))
 
-decryption_key, log_likelihoods = metropolis_sampler_with_bigram(
-    ciphertext, bigram_probs, iterations=iterations, temperature=temperature
-)
+    bigram_probs = train_bigram_model(reference_texts)
+
+    iterations = 10000
+    temperature = 0.85
+
+    decryption_key, log_likelihoods = metropolis_sampler_with_bigram(
+        ciphertext, bigram_probs, iterations=iterations,
+        temperature=temperature
+    )
+
+    decrypted_text = apply_decryption(decryption_key, ciphertext)
 
-decrypted_text = apply_decryption(decryption_key, ciphertext)
+    # Save decrypted text to file
+    with open('some_text_decrypted.txt', 'w') as file:
+        file.write(decrypted_text)
 
-# Save decrypted text to file
-with open('some_text_decrypted.txt', 'w') as file:
-    file.write(decrypted_text)
+    print("Decryption complete. Result saved in 'some_text_decrypted.txt'")
 
-print("Decryption complete. Result saved in 'some_text_decrypted.txt'")
+    # Plot log likelihoods
+    plt.figure(figsize=(10, 6))
+    plt.plot(log_likelihoods)
+    plt.title("Log Likelihood over Metropolis Sampling Iterations")
+    plt.xlabel("Iteration")
+    plt.ylabel("Log Likelihood")
+    plt.grid(True)
+    plt.show()
 
-# Plot log likelihoods
-plt.figure(figsize=(10, 6))
-plt.plot(log_likelihoods)
-plt.title("Log Likelihood over Metropolis Sampling Iterations")
-plt.xlabel("Iteration")
-plt.ylabel("Log Likelihood")
-plt.grid(True)
-plt.show()
 
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ import string
 import random
 from collections import defaultdict
 import numpy as np
-import line_profiler  # type: ignore
 import itertools
 
 
@@ -121,6 +120,8 @@ def main():
 
 
 if __name__ == "__main__":
+    import line_profiler  # type: ignore
+
     profiler = line_profiler.LineProfiler()
 
     profiler.add_function(load_reference_text)
@@ -0,0 +1,158 @@
+"""Parallel, cached parameter sweeps over the Metropolis sampler.
+
+A sweep is a grid of cells over (p, iterations, length, book, seed).
+Each cell encrypts the first length characters of a plaintext with a
+key drawn from its seed, decrypts it with a model trained on the
+reference book and records the correctness of the result. Cells run on
+a process pool and each result is written to the cache directory as
+soon as it completes, keyed by the cell's parameters and the plaintext,
+so an interrupted or extended sweep only computes the missing cells.
+"""
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
+
+from mcmc_decryptor import (  # noqa: E402
+    apply_decryption,
+    cached_model,
+    encrypt_text,
+    load_corpus,
+    metropolis_sampler_with_logs,
+)
+
+Cell = namedtuple('Cell', ['p', 'iterations', 'length', 'book', 'seed'])
+
+
+def grid(p=(0.8,), iterations=(5000,), length=(None,),
+         book=('pg74880.txt',), seed=(0,)):
+    """Every combination of the given parameter values as a list of
+    cells. A length of None uses the whole plaintext."""
+    return [Cell(*values)
+            for values in itertools.product(p, iterations, length, book,
+                                            seed)]
+
+
+def evaluate_correctness(decrypted_text, plaintext):
+    """Fraction of characters decrypted correctly."""
+    return sum(
+        1 for a, b in zip(decrypted_text, plaintext)
+        if a == b) / len(plaintext)
+
+
+def cell_key(cell, plaintext):
+    """Cache key of a cell's result for a given plaintext."""
+    payload = json.dumps(
+        [list(cell), hashlib.sha256(plaintext.encode('utf-8')).hexdigest()])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+@lru_cache(maxsize=None)
+def _reference_model(book):
+    return cached_model(load_corpus(book))
+
+
+def run_cell(cell, plaintext):
+    """Runs the sampler for one cell and returns its result dict."""
+    text = plaintext[:cell.length] if cell.length else plaintext
+    rng = random.Random(cell.seed)
+    letters = list('abcdefghijklmnopqrstuvwxyz')
+    encryption_key = dict(zip(letters, rng.sample(letters, len(letters))))
+    encrypted_text = encrypt_text(text, encryption_key)
+
+    model = _reference_model(cell.book)
+    start = time.perf_counter()
+    decryption_key, summary = metropolis_sampler_with_logs(
+        encrypted_text, model, iterations=cell.iterations, p=cell.p,
+        trace='summary', seed=cell.seed)
+    elapsed = time.perf_counter() - start
+    decrypted_text = apply_decryption(decryption_key, encrypted_text)
+    return {
+        'correctness': evaluate_correctness(decrypted_text, text),
+        'best_log_likelihood': summary['best_log_likelihood'],
+        'acceptance_rate': summary['acceptance_rate'],
+        'elapsed': elapsed,
+    }
+
+
+def _run_cell_task(task):
+    cell, plaintext = task
+    return cell, run_cell(cell, plaintext)
+
+
+def _cache_path(cache_dir, cell, plaintext):
+    return os.path.join(cache_dir, f'{cell_key(cell, plaintext)}.json')
+
+
+def _save_result(path, cell, result):
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump({'cell': cell._asdict(), 'result': result}, file)
+    os.replace(temporary, path)
+
+
+def run_sweep(cells, plaintext, cache_dir='sweep_cache', processes=None):
+    """Returns one dict per cell, in order, with the cell's parameters
+    and its result. Cached cells are read from cache_dir and the rest
+    are computed on a pool of processes workers."""
+    os.makedirs(cache_dir, exist_ok=True)
+    results = {}
+    missing = []
+    for cell in cells:
+        path = _cache_path(cache_dir, cell, plaintext)
+        if os.path.exists(path):
+            with open(path) as file:
+                results[cell] = json.load(file)['result']
+        elif cell not in missing:
+            missing.append(cell)
+
+    if len(missing) == 1 or (missing and processes == 1):
+        completed = map(_run_cell_task,
+                        [(cell, plaintext) for cell in missing])
+        for cell, result in completed:
+            _save_result(_cache_path(cache_dir, cell, plaintext), cell,
+                         result)
+            results[cell] = result
+    elif missing:
+        with multiprocessing.Pool(processes) as pool:
+            for cell, result in pool.imap_unordered(
+                    _run_cell_task,
+                    [(cell, plaintext) for cell in missing]):
+                _save_result(_cache_path(cache_dir, cell, plaintext), cell,
+                             result)
+                results[cell] = result
+
+    return [dict(cell._asdict(), **results[cell]) for cell in cells]
+
+
+def mean_by(rows, parameter, value='correctness'):
+    """Averages value over all rows sharing each value of parameter;
+    returns the sorted parameter values and their means."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[parameter], []).append(row[value])
+    xs = sorted(groups)
+    return xs, [sum(groups[x]) / len(groups[x]) for x in xs]
+
+
+def plot_sweep(rows, parameter, path, title, xlabel,
+               value='correctness', ylabel='Decryption Correctness'):
+    """Plots the mean of value against parameter and saves it to path."""
+    xs, ys = mean_by(rows, parameter, value)
+    figure, axes = plt.subplots()
+    axes.plot(xs, ys, marker='o')
+    axes.set_title(title)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+    axes.grid()
+    figure.savefig(path)
+    plt.close(figure)
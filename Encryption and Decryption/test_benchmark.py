@@ -0,0 +1,48 @@
+from benchmark import Engine, find_regressions, load_engines, run_case
+
+
+def _report(iterations_per_sec, peak_memory_bytes):
+    return {'results': [
+        {'engine': 'mcmc_decryptor', 'length': 100, 'corpus_size': 1000,
+         'iterations': 100, 'seed': seed,
+         'iterations_per_sec': iterations_per_sec,
+         'peak_memory_bytes': peak_memory_bytes}
+        for seed in range(3)]}
+
+
+def test_find_regressions():
+    baseline = _report(1000.0, 10000)
+    assert find_regressions(baseline, _report(950.0, 10500)) == []
+    regressions = find_regressions(baseline, _report(800.0, 20000))
+    assert len(regressions) == 2
+    assert 'iterations_per_sec' in regressions[0]
+    assert 'peak_memory_bytes' in regressions[1]
+
+
+def test_run_case():
+    (engine,), skipped = load_engines(['mcmc_decryptor'])
+    assert skipped == {}
+    result = run_case(engine, "hello there world", "hello there " * 20,
+                      iterations=200, seed=0)
+    assert result['engine'] == 'mcmc_decryptor'
+    assert result['iterations_per_sec'] > 0
+    assert result['peak_memory_bytes'] > 0
+    assert 0 <= result['accuracy'] <= 1
+    assert result['time_to_correct_key'] is None or (
+        0 <= result['time_to_correct_key'] <= result['sampling_time'])
+
+
+def test_run_case_times_the_correct_key():
+    engine = Engine(
+        'fixed', None, build=lambda module, reference: None,
+        sample=lambda module, model, ciphertext, reference, iterations: (
+            {}, [-9.0, -5.0, -2.0, -3.0, -1.0]),
+        score=lambda module, model, ciphertext, decryption: -2.0)
+    result = run_case(engine, "abc", "abc", iterations=4, seed=0,
+                      memory=False)
+    assert result['time_to_correct_key'] == result['sampling_time'] / 2
+
+    engine.score = lambda module, model, ciphertext, decryption: 0.0
+    result = run_case(engine, "abc", "abc", iterations=4, seed=0,
+                      memory=False)
+    assert result['time_to_correct_key'] is None
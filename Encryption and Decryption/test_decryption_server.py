@@ -0,0 +1,89 @@
+import asyncio
+import string
+
+import pytest
+
+from decryption_server import JobClient, JobServer
+from mcmc_decryptor import apply_decryption, encrypt_text
+
+
+def test_job_server_streams_and_cancels():
+    plaintext = "the quick brown fox jumps over the lazy dog " * 10
+    encryption_key = dict(zip(string.ascii_lowercase,
+                              reversed(string.ascii_lowercase)))
+    ciphertext = encrypt_text(plaintext, encryption_key)
+
+    async def run():
+        async with JobServer(plaintext * 5, processes=1,
+                             iterations=5000) as server:
+            client = JobClient(*server.address)
+            job = await client.submit(ciphertext, seed=0)
+            events = [event async for event in client.events(job['id'])]
+            assert events[0]['event'] == 'queued'
+            progress = [event for event in events
+                        if event['event'] == 'progress']
+            finished = events[-1]
+            assert finished['event'] == 'finished'
+            assert finished['state'] == 'done'
+            assert finished['iterations'] == 5000
+            assert finished['log_likelihood'] == (
+                progress[-1]['log_likelihood'])
+            assert finished['plaintext'] == apply_decryption(
+                finished['key'], ciphertext)
+
+            slow = await client.submit(ciphertext, iterations=10 ** 9)
+            queued = await client.submit(ciphertext)
+            assert (await client.cancel(queued['id']))['state'] == (
+                'cancelled')
+            async for event in client.events(slow['id']):
+                if event['event'] == 'started':
+                    await client.cancel(slow['id'])
+            assert event['state'] == 'cancelled'
+            assert event['stop_reason'] == 'cancelled'
+
+            late = await client.submit(ciphertext, iterations=10 ** 9,
+                                       deadline=0.5)
+            events = [event async for event in client.events(late['id'])]
+            assert events[-1]['stop_reason'] == 'deadline'
+
+            with pytest.raises(RuntimeError, match='400'):
+                await client.submit(ciphertext, colour='blue')
+            with pytest.raises(RuntimeError, match='404'):
+                await client.job(12345)
+
+    asyncio.run(run())
+
+
+def test_job_server_rejects_malformed_requests():
+    async def send(address, request):
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(request)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 10)
+        writer.close()
+        return response
+
+    async def run():
+        async with JobServer("hello there world", processes=1) as server:
+            for length in (b'abc', b'-5'):
+                response = await send(
+                    server.address,
+                    b"POST /jobs HTTP/1.1\r\nContent-Length: " + length
+                    + b"\r\n\r\n")
+                assert response.startswith(b"HTTP/1.1 400")
+                assert b"Content-Length" in response
+
+    asyncio.run(run())
+
+
+def test_job_server_forgets_old_finished_jobs():
+    async def run():
+        async with JobServer("hello there world", processes=1,
+                             iterations=100, keep_finished=2) as server:
+            jobs = [server.submit("uryyb gurer") for _ in range(4)]
+            for job in jobs:
+                async for _ in job.stream():
+                    pass
+            assert sorted(server.jobs) == [jobs[2].id, jobs[3].id]
+
+    asyncio.run(run())
@@ -1,13 +1,52 @@
+import cProfile
+import random
+import signal
 import string
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+import mcmc_decryptor
 from mcmc_decryptor import (
+    LETTER_PAIRS,
+    MODEL_CACHE,
+    BigramModel,
+    CorpusCounts,
+    CountStore,
+    Decryptor,
+    NgramModel,
+    ProposalRandom,
+    SamplerStats,
+    bigram_count_table,
+    count_corpus_file,
+    encode_text,
+    frequency_rank_permutation,
     preprocess_text,
+    build_count_store,
     build_frequency_matrix,
+    cached_model,
+    ciphertext_count_table,
+    decrypt_stream,
     compute_log_likelihood,
+    cooling_schedule,
     apply_decryption,
     random_swap,
     metropolis_sampler_with_logs,
+    metropolis_sampler_multichain,
+    metropolis_sampler_parallel_restarts,
+    metropolis_sampler_parallel_tempering,
     generate_encryption_key,
-    encrypt_text
+    encrypt_text,
+    encrypt_file,
+    decrypt_file,
+    translate_file,
+    key_to_permutation,
+    load_corpus,
+    ngram_indices,
+    permutation_to_key,
+    polish_key,
+    steepest_ascent,
+    swap_delta,
 )
 
 
@@ -17,6 +56,97 @@ def test_preprocess_text():
     assert processed_text == "hello world"
 
 
+def test_load_corpus_matches_preprocess_text(tmp_path):
+    text = "Ünïcode \u0130s \u212aept, Tabs\tand\r\nnew lines. 42!"
+    path = tmp_path / "corpus.txt"
+    path.write_bytes(text.encode('utf-8'))
+    assert load_corpus(path) == preprocess_text(text)
+    path.write_bytes(b"Plain ASCII, Only.\n")
+    assert load_corpus(path) == "plain ascii only"
+
+
+def test_count_corpus_file_handles_chunk_boundaries(tmp_path):
+    path = tmp_path / "book.txt"
+    path.write_text("Caf\u00e9 society, the end.\nThe \u0130dle start " * 20,
+                    encoding='utf-8')
+    expected = bigram_count_table(encode_text(load_corpus(path)))
+    for chunk_size in (1, 5, 64, 1 << 20):
+        assert np.array_equal(count_corpus_file(path, chunk_size), expected)
+    codes = encode_text(load_corpus(path))
+    trigrams = np.bincount(ngram_indices(codes, 3), minlength=28 ** 3)
+    for chunk_size in (1, 2, 7, 1 << 20):
+        assert np.array_equal(
+            count_corpus_file(path, chunk_size, order=3).ravel(), trigrams)
+
+
+def test_corpus_counts_add_files_incrementally(tmp_path):
+    (tmp_path / "a.txt").write_text("the first book")
+    (tmp_path / "b.txt").write_text("a second book")
+    corpus = CorpusCounts()
+    assert len(corpus.add_files(tmp_path / "a.txt")) == 1
+    assert len(corpus.add_files(tmp_path, processes=1)) == 1
+    assert corpus.add_files(str(tmp_path / "*.txt")) == []
+    expected = (bigram_count_table(encode_text("the first book"))
+                + bigram_count_table(encode_text("a second book")))
+    assert np.array_equal(corpus.counts, expected)
+
+    corpus.save(tmp_path / "corpus.npz")
+    loaded = CorpusCounts.load(tmp_path / "corpus.npz")
+    assert np.array_equal(loaded.counts, expected)
+    assert loaded.files == corpus.files
+
+
+def test_count_store_sums_per_book_tables(tmp_path):
+    (tmp_path / "a.txt").write_text(
+        "Title: First\nLanguage: English\n\nthe first book")
+    (tmp_path / "b.txt").write_text("a second book")
+    path = tmp_path / "store.npz"
+    store = build_count_store(path, tmp_path, orders=(2, 3), processes=1)
+    assert store.names == ["a", "b"]
+    assert store.book("a")["title"] == "First"
+    assert store.book("a")["characters"] == len(
+        load_corpus(tmp_path / "a.txt"))
+
+    texts = [load_corpus(tmp_path / name) for name in ("a.txt", "b.txt")]
+    expected = sum(bigram_count_table(encode_text(text)) for text in texts)
+    assert np.array_equal(store.counts(), expected)
+    assert np.array_equal(store.counts("b"),
+                          bigram_count_table(encode_text(texts[1])))
+    assert np.allclose(store.model(["a", "b"]).log_probs,
+                       BigramModel.from_counts(expected).log_probs)
+    assert store.model(order=3).order == 3
+    mixture = store.counts({"a": 1.0, "b": 1.0})
+    assert np.isclose(mixture.sum(), 2.0)
+
+    loaded = CountStore.load(path)
+    assert loaded.names == store.names
+    assert np.array_equal(loaded.counts(order=3), store.counts(order=3))
+    assert build_count_store(path, tmp_path, orders=(2, 3)).add_files(
+        tmp_path) == []
+
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "a.txt").write_text("a different first book")
+    with pytest.raises(ValueError):
+        store.add_files(tmp_path / "other" / "a.txt")
+    assert store.names == ["a", "b"]
+
+    many = tmp_path / "many"
+    many.mkdir()
+    for index, repeats in enumerate((20000, 1, 1, 1)):
+        (many / f"book{index}.txt").write_text("the book " * repeats)
+    names = [f"book{index}" for index in range(4)]
+    store = CountStore()
+    assert store.add_files(many, processes=2) == names
+    assert store.names == names
+
+
+def test_build_frequency_matrix():
+    assert build_frequency_matrix("abab") == {
+        ('a', 'b'): 2 / 3, ('b', 'a'): 1 / 3}
+    assert build_frequency_matrix("a\nb") == {
+        ('a', '\n'): 1 / 2, ('\n', 'b'): 1 / 2}
+
+
 def test_compute_log_likelihood():
     reference_text = "hello hello"
     encrypted_text = "abcde abcde"
@@ -27,6 +157,41 @@ def test_compute_log_likelihood():
     assert isinstance(log_likelihood, float)
 
 
+def test_compute_log_likelihood_keeps_unpreprocessed_bigrams():
+    frequency_matrix = build_frequency_matrix(
+        "Hello, World! hello world.\nHi, there")
+    text = "hello, world"
+    expected = sum(np.log(max(frequency_matrix.get(pair, 0), 1e-6))
+                   for pair in zip(text, text[1:]))
+    assert np.isclose(compute_log_likelihood({}, text, frequency_matrix),
+                      expected)
+
+
+def test_bigram_model_matches_frequency_matrix():
+    reference_text = preprocess_text("The cat sat on the mat, then the hat.")
+    text = "that cat ate the rat"
+    frequency_matrix = build_frequency_matrix(reference_text)
+    model = BigramModel.from_text(reference_text)
+    assert model.log_probs.shape == (28, 28)
+    decryption = {char: char for char in string.ascii_lowercase}
+    expected = compute_log_likelihood(decryption, text, frequency_matrix)
+    assert np.isclose(model.score(text), expected)
+    assert np.isclose(
+        compute_log_likelihood(decryption, text, model), expected)
+
+
+def test_cached_model_reuses_memory_and_disk(tmp_path):
+    reference_text = "a reference text only used by this test"
+    model = cached_model(reference_text, cache_dir=tmp_path)
+    assert cached_model(reference_text, cache_dir=tmp_path) is model
+    assert len(list(tmp_path.glob('bigram-*.npy'))) == 1
+
+    MODEL_CACHE.clear()
+    reloaded = cached_model(reference_text, cache_dir=tmp_path)
+    assert reloaded is not model
+    assert np.array_equal(reloaded.log_probs, model.log_probs)
+
+
 def test_apply_decryption():
     decryption = {'a': 'x', 'b': 'y', 'c': 'z'}
     encrypted_text = "abc"
@@ -42,6 +207,107 @@ def test_random_swap():
     assert len(swapped) == 2
 
 
+def test_permutation_round_trip_and_swap_delta():
+    model = BigramModel.from_text("the cat sat on the mat")
+    text = "abcab cba"
+    key = generate_encryption_key()
+    plain = key_to_permutation(key)
+    assert permutation_to_key(plain) == key
+
+    counts = model.count_table(text)
+    delta = swap_delta(counts, model.log_probs, plain, 0, 2)
+    swapped = permutation_to_key(plain)
+    assert swapped['a'] == key['c'] and swapped['c'] == key['a']
+    assert np.isclose(
+        delta, model.score(apply_decryption(swapped, text))
+        - model.score(apply_decryption(key, text)))
+
+
+def test_ngram_scorer_swap_delta_matches_full_rescoring():
+    reference_text = "the quick brown fox jumps over the lazy dog " * 3
+    text = "wkh txlfn eurzq ira mxpsv ryhu wkh odcb grj"
+    for order in (3, 4):
+        model = NgramModel.from_text(reference_text, order)
+        assert model.log_probs.shape == (28,) * order
+        scorer = model.scorer(text)
+        rng = random.Random(order)
+        plain = np.arange(model.size)
+        current = scorer.score(plain)
+        for _ in range(50):
+            a, b = rng.sample(range(26), 2)
+            current += scorer.swap_delta(plain, a, b)
+            decrypted = apply_decryption(permutation_to_key(plain), text)
+            assert np.isclose(current, model.score(decrypted))
+
+
+def test_metropolis_sampler_stats_and_profile(monkeypatch, caplog):
+    stats = SamplerStats()
+    profile = cProfile.Profile()
+    _, _, info = metropolis_sampler_with_logs(
+        "abcde abcde", "hello hello", iterations=300, return_info=True,
+        stats=stats, profile=profile, seed=0)
+    assert stats.proposals == 300
+    assert stats.acceptances == info['acceptances']
+    assert 0 < stats.improvements <= stats.acceptances
+    assert 0 < stats.scoring_time < stats.sampling_time
+    assert stats.iterations_per_sec > 0
+    assert info['stats'] == stats.as_dict()
+    assert profile.getstats()
+
+    monkeypatch.setenv('MCMC_DECRYPTOR_INSTRUMENT', '1')
+    with caplog.at_level('INFO', logger='mcmc_decryptor'):
+        metropolis_sampler_with_logs(
+            "abcde abcde", "hello hello", iterations=10)
+    assert 'Sampler stats' in caplog.text
+
+
+def test_metropolis_sampler_resumes_from_checkpoint(tmp_path, monkeypatch):
+    encrypted_text = "abcde fghbc ijkda " * 5
+    reference_text = "hello there hello world"
+    options = {'iterations': 5000, 'p': 0.5, 'return_info': True}
+    random.seed(7)
+    expected = metropolis_sampler_with_logs(
+        encrypted_text, reference_text, **options)
+
+    swap_delta_method = mcmc_decryptor.BigramScorer.swap_delta
+    calls = []
+
+    def preempted(self, plain, a, b):
+        calls.append(None)
+        if len(calls) > 3000:
+            raise KeyboardInterrupt
+        return swap_delta_method(self, plain, a, b)
+
+    path = tmp_path / "run.ckpt"
+    monkeypatch.setattr(mcmc_decryptor.BigramScorer, 'swap_delta', preempted)
+    random.seed(7)
+    with pytest.raises(KeyboardInterrupt):
+        metropolis_sampler_with_logs(
+            encrypted_text, reference_text, checkpoint=path,
+            checkpoint_interval=0, **options)
+    monkeypatch.undo()
+
+    random.seed(12345)
+    resumed = metropolis_sampler_with_logs(
+        encrypted_text, reference_text, checkpoint=path,
+        checkpoint_interval=0, resume=True, **options)
+    assert resumed == expected
+
+    with pytest.raises(ValueError):
+        metropolis_sampler_with_logs(
+            encrypted_text, reference_text, checkpoint=path, resume=True,
+            iterations=10)
+
+
+def test_metropolis_sampler_with_logs_trigrams():
+    reference_text = "hello there hello world"
+    encrypted_text = "abcde fghbc"
+    best_decryption, log_likelihoods = metropolis_sampler_with_logs(
+        encrypted_text, reference_text, iterations=300, order=3)
+    assert sorted(best_decryption.values()) == list(string.ascii_lowercase)
+    assert len(log_likelihoods) == 301
+
+
 def test_metropolis_sampler_with_logs():
     reference_text = "hello hello"
     encrypted_text = "abcde abcde"  # Use a mock encrypted text
@@ -54,6 +320,301 @@ def test_metropolis_sampler_with_logs():
     assert len(log_likelihoods) == 1001
 
 
+def test_metropolis_sampler_stops_early():
+    reference_text = "hello hello"
+    encrypted_text = "abcde abcde"
+    for scoring in ('delta', 'full'):
+        _, log_likelihoods, info = metropolis_sampler_with_logs(
+            encrypted_text, reference_text, iterations=1000, p=0.5,
+            scoring=scoring, plateau=50, return_info=True)
+        assert info['stop_reason'] == 'plateau'
+        assert info['iterations'] < 1000
+        assert len(log_likelihoods) == info['iterations'] + 1
+
+    _, _, info = metropolis_sampler_with_logs(
+        encrypted_text, reference_text, iterations=100, return_info=True)
+    assert info['iterations'] == 100
+    assert info['stop_reason'] == 'iterations'
+
+
+def test_metropolis_sampler_trace_modes():
+    reference_text = "hello hello"
+    encrypted_text = "abcde abcde"
+    random.seed(5)
+    _, full_trace = metropolis_sampler_with_logs(
+        encrypted_text, reference_text, iterations=100)
+
+    traces = {}
+    for trace, options in [('array', {'thin': 10}),
+                           ('ring', {'trace_size': 7}),
+                           ('summary', {})]:
+        random.seed(5)
+        _, traces[trace] = metropolis_sampler_with_logs(
+            encrypted_text, reference_text, iterations=100, trace=trace,
+            **options)
+    assert np.allclose(traces['array'], full_trace[::10])
+    assert np.allclose(traces['ring'], full_trace[-7:])
+    assert np.isclose(traces['summary']['final_log_likelihood'],
+                      full_trace[-1])
+    assert np.isclose(traces['summary']['best_log_likelihood'],
+                      max(full_trace))
+    assert 0 <= traces['summary']['acceptance_rate'] <= 1
+
+
+def test_metropolis_sampler_delta_matches_full_scoring():
+    reference_text = preprocess_text("the quick brown fox jumps over the lazy"
+                                     " dog and then the fox sleeps")
+    encrypted_text = encrypt_text(reference_text, generate_encryption_key())
+    results = []
+    for scoring in ('full', 'delta'):
+        random.seed(0)
+        results.append(metropolis_sampler_with_logs(
+            encrypted_text, reference_text, iterations=300, p=0.8,
+            scoring=scoring))
+    (full_key, full_logs), (delta_key, delta_logs) = results
+    assert np.allclose(delta_logs, full_logs)
+    # Distinct keys can tie on this short text, so compare their scores.
+    model = BigramModel.from_text(reference_text)
+    assert np.isclose(model.score(apply_decryption(delta_key, encrypted_text)),
+                      model.score(apply_decryption(full_key, encrypted_text)))
+
+
+def test_metropolis_sampler_seed_is_reproducible():
+    reference_text = "hello there hello world"
+    encrypted_text = "abcde fghbc"
+    runs = [metropolis_sampler_with_logs(
+        encrypted_text, reference_text, iterations=500, seed=seed)
+        for seed in (3, 3, np.random.default_rng(3))]
+    assert runs[0] == runs[1] == runs[2]
+
+    rng = ProposalRandom(4, block_size=8)
+    draws = [rng.draw() for _ in range(5)]
+    assert all(a != b and 0 <= a < 26 and 0 <= b < 26 and threshold <= 0
+               for a, b, threshold in draws)
+    state = rng.getstate()
+    ahead = [rng.draw() for _ in range(10)]
+    rng.setstate(state)
+    assert [rng.draw() for _ in range(10)] == ahead
+
+
+def test_frequency_rank_permutation_and_initial_keys():
+    cipher_frequencies = np.zeros(28)
+    cipher_frequencies[[1, 2]] = [5, 9]
+    reference_frequencies = np.zeros(28)
+    reference_frequencies[[4, 19]] = [0.2, 0.1]
+    plain = frequency_rank_permutation(cipher_frequencies,
+                                       reference_frequencies)
+    assert plain[2] == 4 and plain[1] == 19
+    assert sorted(plain[:26]) == list(range(26))
+    assert list(plain[26:]) == [26, 27]
+
+    reference_text = "the cat sat on the mat with the hat"
+    random.seed(2)
+    encryption_key = generate_encryption_key()
+    encrypted_text = encrypt_text(reference_text, encryption_key)
+    decryption = {v: k for k, v in encryption_key.items()}
+    best_decryption, log_likelihoods = metropolis_sampler_with_logs(
+        encrypted_text, reference_text, iterations=0,
+        initial_key=decryption)
+    assert best_decryption == decryption
+    model = BigramModel.from_text(reference_text)
+    for initial_key in ('frequency', 'greedy'):
+        _, log_likelihoods = metropolis_sampler_with_logs(
+            encrypted_text, reference_text, iterations=0,
+            initial_key=initial_key)
+        assert log_likelihoods[0] > model.score(encrypted_text)
+    for invalid in ({'a': 'b'}, {'a': ' ', ' ': 'a'}):
+        with pytest.raises(ValueError):
+            metropolis_sampler_with_logs(
+                "abc abc", "hello there", initial_key=invalid)
+
+
+def test_steepest_ascent_reaches_a_local_optimum():
+    reference_text = preprocess_text(
+        "the quick brown fox jumps over the lazy dog and then the fox "
+        "sleeps while the dog watches the quiet brown hens")
+    model = BigramModel.from_text(reference_text)
+    random.seed(4)
+    encrypted_text = encrypt_text(reference_text, generate_encryption_key())
+    for order in (2, 3):
+        if order == 3:
+            model = NgramModel.from_text(reference_text, 3)
+        scorer = model.scorer(encrypted_text)
+        plain = np.arange(model.size)
+        deltas = scorer.pair_deltas(plain, *LETTER_PAIRS)
+        assert len(deltas) == 325
+        assert list(plain) == list(range(model.size))
+        a, b = LETTER_PAIRS[0][7], LETTER_PAIRS[1][7]
+        assert np.isclose(scorer.swap_delta(plain.copy(), a, b), deltas[7])
+
+        before = scorer.score(plain)
+        _, gain, swaps = steepest_ascent(scorer, plain)
+        assert swaps > 0
+        assert np.isclose(scorer.score(plain), before + gain)
+        assert scorer.pair_deltas(plain, *LETTER_PAIRS).max() <= 1e-9
+        _, _, swaps = steepest_ascent(
+            scorer, np.arange(model.size), max_swaps=1)
+        assert swaps == 1
+
+    decryption = polish_key({}, encrypted_text, reference_text)
+    _, _, info = metropolis_sampler_with_logs(
+        encrypted_text, reference_text, iterations=50, polish=True,
+        return_info=True, seed=0)
+    assert info['polish_swaps'] >= 0
+    assert sorted(decryption.values()) == list(string.ascii_lowercase)
+
+
+def test_cooling_schedules():
+    for name in ('linear', 'geometric', 'logarithmic', 'reheat'):
+        temperature = cooling_schedule(name, 8.0, 0.5, 1000)
+        assert np.isclose(temperature(0, 0), 8.0)
+        assert np.isclose(temperature(1000, 0), 0.5)
+        assert temperature(500, 0) < 8.0
+    assert cooling_schedule('constant', 8.0, 0.5, 1000)(10, 0) == 0.5
+
+    reheat = cooling_schedule('reheat', 8.0, 0.5, 1000)
+    assert reheat(400, 10) < 8.0
+    assert reheat(401, 100) == 8.0
+
+    def custom(step, since_improvement):
+        return 1.0
+    assert cooling_schedule(custom, 8.0, 0.5, 1000) is custom
+    with pytest.raises(ValueError):
+        cooling_schedule('cubic', 8.0, 0.5, 1000)
+
+
+def test_metropolis_sampler_multichain():
+    reference_text = "hello hello"
+    encrypted_text = "abcde abcde"
+    best_decryption, log_likelihoods = metropolis_sampler_multichain(
+        encrypted_text, reference_text, chains=8, iterations=200, seed=1)
+    assert sorted(best_decryption.values()) == list(string.ascii_lowercase)
+    assert log_likelihoods.shape == (201, 8)
+
+    _, repeated = metropolis_sampler_multichain(
+        encrypted_text, reference_text, chains=8, iterations=200, seed=1)
+    assert np.array_equal(log_likelihoods, repeated)
+
+
+def test_metropolis_sampler_parallel_tempering():
+    reference_text = "hello hello"
+    encrypted_text = "abcde abcde"
+    best_decryption, log_likelihoods = metropolis_sampler_parallel_tempering(
+        encrypted_text, reference_text, p_values=[0.2, 0.5, 1.0],
+        iterations=300, exchange_interval=5, seed=2)
+    assert sorted(best_decryption.values()) == list(string.ascii_lowercase)
+    assert log_likelihoods.shape == (301, 3)
+
+
+@contextmanager
+def time_limit(seconds):
+    """Fails the test with TimeoutError instead of letting a pool hang."""
+    if not hasattr(signal, 'SIGALRM'):
+        yield
+        return
+
+    def expire(signum, frame):
+        raise TimeoutError(f"Timed out after {seconds} seconds")
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.alarm(seconds)
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def test_metropolis_sampler_parallel_restarts():
+    reference_text = "hello hello"
+    encrypted_text = "abcde abcde"
+    with time_limit(60):
+        best_decryption, best_log_likelihoods = (
+            metropolis_sampler_parallel_restarts(
+                encrypted_text, reference_text, restarts=4, iterations=200,
+                processes=2, seed=1))
+    assert sorted(best_decryption.values()) == list(string.ascii_lowercase)
+    assert len(best_log_likelihoods) == 4
+
+    with time_limit(60):
+        _, best_log_likelihoods = metropolis_sampler_parallel_restarts(
+            encrypted_text, reference_text, restarts=4, iterations=200,
+            processes=2, agreement=1, seed=1)
+    assert len(best_log_likelihoods) == 1
+
+
+def test_ciphertext_count_table_matches_count_table(tmp_path):
+    text = "wkh fdw vdw\ron wkh pdw, éh? " * 20
+    path = tmp_path / "cipher.txt"
+    path.write_bytes(text.encode('utf-8'))
+    model = BigramModel.from_text("the cat sat on the mat")
+    expected = model.count_table(text)
+    for chunk_size in (1, 7, 1 << 20):
+        assert np.array_equal(
+            ciphertext_count_table(path, chunk_size), expected)
+
+
+def test_decrypt_stream_writes_decrypted_file(tmp_path):
+    reference_text = "hello hello"
+    source = tmp_path / "cipher.txt"
+    destination = tmp_path / "plain.txt"
+    source.write_bytes("abcde abcde\n".encode('utf-8'))
+    best_decryption, _ = decrypt_stream(
+        source, reference_text, destination, chunk_size=4, iterations=200)
+    assert destination.read_text(encoding='utf-8') == apply_decryption(
+        best_decryption, "abcde abcde\n")
+
+
+def test_decryptor_decrypt_many_matches_decrypt():
+    messages = ["abcde abcde", "ab", "edcba abc abcde"]
+    with Decryptor("hello there hello", iterations=300, processes=2,
+                   seed=3) as decryptor:
+        results = dict(decryptor.decrypt_many(messages))
+    serial = Decryptor("hello there hello", iterations=300, seed=3)
+    expected = [serial.decrypt(message) for message in messages]
+    assert sorted(results) == [0, 1, 2]
+    assert [results[index] for index in range(3)] == expected
+
+
+def test_message_chain_segments_continue_each_other():
+    model = BigramModel.from_text(
+        "it was the best of times it was the worst of times " * 5)
+    plaintext = "the quick brown fox jumps over the lazy dog " * 4
+    for seed in range(4):
+        key = dict(zip(string.ascii_lowercase, random.Random(seed).sample(
+            string.ascii_lowercase, 26)))
+        ciphertext = encrypt_text(plaintext, key)
+        whole, segmented = (
+            mcmc_decryptor._run_message_chain(
+                model, ciphertext, seed, 20000, 1.0, 500, None, None,
+                segment=segment)
+            for segment in (None, 50))
+        assert whole[2]['stop_reason'] == 'plateau'
+        assert segmented == whole
+
+
+def test_encrypt_and_decrypt_file_round_trip(tmp_path):
+    data = "Thé quick\r\nbrown fox, 42!\n".encode('utf-8') * 50 + b"\xff"
+    source = tmp_path / "plain.txt"
+    source.write_bytes(data)
+    encryption_key = generate_encryption_key()
+    decryption = {v: k for k, v in encryption_key.items()}
+    encrypt_file(encryption_key, source, tmp_path / "cipher.txt",
+                 chunk_size=5)
+    decrypt_file(decryption, tmp_path / "cipher.txt",
+                 tmp_path / "round.txt", chunk_size=7)
+    assert (tmp_path / "round.txt").read_bytes() == data
+
+    text = data.decode('utf-8', 'surrogateescape')
+    expected = encrypt_text(text, encryption_key).encode(
+        'utf-8', 'surrogateescape')
+    assert (tmp_path / "cipher.txt").read_bytes() == expected
+
+    translate_file({'é': 'e', 'q': 'Q'}, source, tmp_path / "other.txt",
+                   chunk_size=3)
+    assert (tmp_path / "other.txt").read_bytes() == data.replace(
+        "é".encode('utf-8'), b"e").replace(b"q", b"Q")
+
+
 def test_generate_encryption_key():
     encryption_key = generate_encryption_key()
 
@@ -69,3 +630,4 @@ def test_encrypt_text():
     encrypted_text = encrypt_text(plaintext, encryption_key)
     assert encrypted_text != plaintext
     assert all(char in string.ascii_lowercase for char in encrypted_text)
+
@@ -0,0 +1,104 @@
+import random
+import string
+
+import numpy as np
+import pytest
+
+import mcmc_decryptor
+from mcmc_text_decryption import (
+    apply_decryption,
+    calculate_bigram_likelihood,
+    metropolis_sampler_with_bigram,
+    train_bigram_model,
+)
+
+PLAINTEXT = ("it was the best of times it was the worst of times "
+             "it was the age of wisdom it was the age of foolishness ")
+ENCRYPTION_KEY = dict(zip(string.ascii_lowercase, random.Random(1).sample(
+    string.ascii_lowercase, 26)))
+CIPHERTEXT = PLAINTEXT.translate(str.maketrans(ENCRYPTION_KEY)) + "!"
+BIGRAM_PROBS = train_bigram_model([PLAINTEXT * 5])
+
+
+def test_bigram_sampler_returns_the_best_encryption_key():
+    key, log_likelihoods = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=500, seed=0)
+    assert sorted(key) == list(string.ascii_lowercase)
+    assert sorted(key.values()) == list(string.ascii_lowercase)
+    assert len(log_likelihoods) == 501
+    decrypted = apply_decryption(key, CIPHERTEXT)
+    assert decrypted.endswith("!")
+    assert np.isclose(calculate_bigram_likelihood(decrypted, BIGRAM_PROBS),
+                      max(log_likelihoods))
+
+
+def test_bigram_sampler_seed_is_reproducible():
+    first = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=300, seed=4)
+    second = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=300,
+        seed=np.random.default_rng(4))
+    assert first == second
+
+
+def test_bigram_sampler_starts_from_an_encryption_key():
+    key, log_likelihoods = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=0, initial_key=ENCRYPTION_KEY)
+    assert key == ENCRYPTION_KEY
+    assert np.isclose(log_likelihoods[0], calculate_bigram_likelihood(
+        PLAINTEXT + "!", BIGRAM_PROBS))
+    for invalid in ({'a': 'x', 'b': 'x'}, {'a': 'b'}):
+        with pytest.raises(ValueError):
+            metropolis_sampler_with_bigram(
+                CIPHERTEXT, BIGRAM_PROBS, initial_key=invalid)
+
+
+def test_bigram_sampler_stops_early():
+    _, log_likelihoods, info = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=100000, plateau=50,
+        initial_key=ENCRYPTION_KEY, return_info=True, seed=0)
+    assert info['stop_reason'] == 'plateau'
+    assert info['iterations'] == 50
+    assert len(log_likelihoods) == 51
+
+
+def test_bigram_sampler_temperature_schedules():
+    _, _, info = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=200, temperature=0.5,
+        schedule='linear', start_temperature=4.0, return_info=True, seed=0)
+    temperatures = info['temperatures']
+    assert len(temperatures) == 200
+    assert np.isclose(temperatures[0], 4.0 - 3.5 / 200)
+    assert np.isclose(temperatures[-1], 0.5)
+
+    def custom(step, since_improvement):
+        return 2.0 if step % 2 else 1.0
+    _, _, info = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=4, schedule=custom,
+        return_info=True, seed=0)
+    assert info['temperatures'] == [2.0, 1.0, 2.0, 1.0]
+
+    assert len(metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=4, seed=0)) == 2
+    with pytest.raises(ValueError):
+        metropolis_sampler_with_bigram(
+            CIPHERTEXT, BIGRAM_PROBS, iterations=4, schedule='cubic')
+
+
+def test_bigram_sampler_polish():
+    key, log_likelihoods, info = metropolis_sampler_with_bigram(
+        CIPHERTEXT, BIGRAM_PROBS, iterations=20, polish=True,
+        return_info=True, seed=0)
+    assert info['polish_swaps'] > 0
+    assert info['polish_gain'] > 0
+    assert np.isclose(
+        calculate_bigram_likelihood(apply_decryption(key, CIPHERTEXT),
+                                    BIGRAM_PROBS),
+        max(log_likelihoods) + info['polish_gain'])
+
+
+def test_bigram_sampler_bounds_the_alphabet_cache():
+    for offset in range(100):
+        metropolis_sampler_with_bigram(
+            CIPHERTEXT + chr(0x1F600 + offset), BIGRAM_PROBS, iterations=1)
+    assert mcmc_decryptor._symbol_lookup.cache_info().currsize <= 64
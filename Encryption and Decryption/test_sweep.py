@@ -0,0 +1,26 @@
+import os
+
+import sweep
+from sweep import grid, mean_by, run_sweep
+
+
+def test_run_sweep_caches_cells(tmp_path, monkeypatch):
+    plaintext = "the quick brown fox jumps over the lazy dog"
+    cells = grid(iterations=[50], length=[20, None], seed=[0, 1])
+    rows = run_sweep(cells, plaintext, cache_dir=tmp_path, processes=2)
+    assert [(row['length'], row['seed']) for row in rows] == [
+        (20, 0), (20, 1), (None, 0), (None, 1)]
+    assert all(0 <= row['correctness'] <= 1 for row in rows)
+    assert len(os.listdir(tmp_path)) == 4
+
+    def fail(task):
+        raise AssertionError(f"cell {task[0]} was recomputed")
+
+    monkeypatch.setattr(sweep, '_run_cell_task', fail)
+    assert run_sweep(cells, plaintext, cache_dir=tmp_path) == rows
+
+
+def test_mean_by():
+    rows = [{'p': 0.5, 'correctness': 0.2}, {'p': 0.1, 'correctness': 0.4},
+            {'p': 0.5, 'correctness': 0.6}]
+    assert mean_by(rows, 'p') == ([0.1, 0.5], [0.4, 0.4])